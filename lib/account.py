@@ -77,17 +77,25 @@ class Account(object):
 
     def synchronize_sequence(self, wallet, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        # during a restore, the window is extended as soon as a server
+        # announces a history, so that histories are fetched together.
+        # The missing part of the window is created at once, leaving
+        # exactly limit unused addresses at the end.
+        is_used = wallet.address_is_announced if wallet.is_restoring() else wallet.address_is_old
+        new_addresses = []
         while True:
             addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+            unused = 0
+            for address in reversed(addresses[-limit:]):
+                if is_used(address):
+                    break
+                unused += 1
+            if unused >= limit:
                 break
-            else:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
+            for i in range(limit - unused):
+                new_addresses.append(self.create_new_address(for_change))
+        if new_addresses:
+            wallet.add_addresses(new_addresses)
 
     def synchronize(self, wallet):
         self.synchronize_sequence(wallet, False)
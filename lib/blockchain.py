@@ -18,16 +18,24 @@
 
 
 import threading, time, Queue, os, sys, shutil
-from util import user_dir, appdata_dir, print_error, print_msg
+from util import user_dir, appdata_dir, print_error, print_msg, LRUCache
 from bitcoin import *
+import checkpoints
 import hashlib
-import sqlite3
+import collections
+import mmap
+import struct
+import multiprocessing
 
 try:
     from ltc_scrypt import getPoWHash as getPoWScryptHash
+    getPoWScryptHashes = None
 except ImportError:
     print_msg("Warning: ltc_scrypt not available, using fallback")
     from scrypt import scrypt_1024_1_1_80 as getPoWScryptHash
+    from scrypt import scrypt_1024_1_1_80_batch as getPoWScryptHashes
+
+from scrypt import BATCH_MIN_LANES
 
 try:
     from groestl_hash import getPoWHash as getPoWGroestlHash
@@ -48,6 +56,165 @@ except ImportError:
     raise
 
 
+# block versions of the five Myriad algorithms
+ALGO_SHA256D = 2
+ALGO_SCRYPT = 514
+ALGO_GROESTL = 1026
+ALGO_SKEIN = 1538
+ALGO_QUBIT = 2050
+ALGOS = [ALGO_SHA256D, ALGO_SCRYPT, ALGO_GROESTL, ALGO_SKEIN, ALGO_QUBIT]
+
+# each algo retargets from its own last 10 blocks
+RETARGET_WINDOW = 10
+
+# number of decoded headers kept by read_header
+HEADER_CACHE_SIZE = 4096
+
+# the proof of work worker pool, if verification_workers is set, is only
+# used for at least this many headers, i.e. for full chunks
+POOL_MIN_HEADERS = 2016
+
+# chunk download: outstanding requests per server, seconds to wait for
+# a chunk, and how many times a chunk is requested again before giving up
+CHUNK_PREFETCH = 4
+CHUNK_TIMEOUT = 30
+CHUNK_RETRIES = 3
+
+# headers file bootstrap: chunks downloaded ahead of verification, and
+# socket timeout in seconds
+BOOTSTRAP_PREFETCH = 4
+BOOTSTRAP_TIMEOUT = 30
+
+# reorg resolution: headers probed per bisection round, and longest
+# range requested as single headers rather than as chunks
+HEADER_PROBES = 8
+HEADER_BATCH = 50
+
+
+class ChunkLinkError(Exception):
+    """ the first header of a chunk does not follow the local header
+    below it, i.e. the local chain has forked away from the server """
+    pass
+
+
+def pow_hash(raw_header):
+    """ proof-of-work hash of a raw header, with the algo selected by
+    its version. Module level, so that it can run in a worker pool. """
+    version, = struct.unpack_from('<I', raw_header, 0)
+    if version == ALGO_SHA256D:
+        h = Hash(raw_header)
+    elif version == ALGO_SCRYPT:
+        h = getPoWScryptHash(raw_header)
+    elif version == ALGO_GROESTL:
+        h = getPoWGroestlHash(raw_header)
+    elif version == ALGO_SKEIN:
+        h = getPoWSkeinHash(raw_header)
+    elif version == ALGO_QUBIT:
+        h = getPoWQubitHash(raw_header)
+    else:
+        return None
+    return h[::-1].encode('hex')
+
+
+class Header(object):
+    """ a block header, kept as its raw 80 bytes. The integer fields are
+    decoded once; the hashes are computed on first use and cached. """
+
+    __slots__ = ('raw', 'block_height', 'version', 'timestamp', 'bits', 'nonce', '_hash', '_pow_hash')
+
+    def __init__(self, raw, block_height=None):
+        assert len(raw) == 80
+        self.raw = raw
+        self.block_height = block_height
+        self.version, = struct.unpack_from('<I', raw, 0)
+        self.timestamp, self.bits, self.nonce = struct.unpack_from('<III', raw, 68)
+        self._hash = None
+        self._pow_hash = None
+
+    @classmethod
+    def from_dict(cls, d):
+        raw = struct.pack('<I32s32sIII', d.get('version'), hash_decode(d.get('prev_block_hash')),
+                          hash_decode(d.get('merkle_root')), int(d.get('timestamp')),
+                          int(d.get('bits')), int(d.get('nonce')))
+        return cls(raw, d.get('block_height'))
+
+    def as_dict(self):
+        return {'version': self.version, 'prev_block_hash': self.prev_block_hash,
+                'merkle_root': self.merkle_root, 'timestamp': self.timestamp,
+                'bits': self.bits, 'nonce': self.nonce, 'block_height': self.block_height}
+
+    @property
+    def prev_block_hash(self):
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self):
+        return hash_encode(self.raw[36:68])
+
+    def get(self, key, default=None):
+        # same interface as the header dicts sent by servers
+        return getattr(self, key, default)
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = hash_encode(Hash(self.raw))
+        return self._hash
+
+    def pow_hash(self):
+        if self._pow_hash is None:
+            self._pow_hash = pow_hash(self.raw)
+        return self._pow_hash
+
+
+class AlgoWindow(object):
+    """ (height, timestamp, bits) of the last RETARGET_WINDOW headers of
+    each algo, for the headers below self.height """
+
+    def __init__(self, height):
+        self.height = height
+        self.headers = {}
+
+    def get(self, algo):
+        d = self.headers.get(algo)
+        if d is None:
+            d = self.headers[algo] = collections.deque(maxlen=RETARGET_WINDOW)
+        return d
+
+    def push(self, height, algo, timestamp, bits):
+        assert height == self.height
+        self.get(algo).append((height, timestamp, bits))
+        self.height += 1
+
+    def push_front(self, height, algo, timestamp, bits):
+        # used when rebuilding the window backwards from the headers file
+        d = self.get(algo)
+        if len(d) < RETARGET_WINDOW:
+            d.appendleft((height, timestamp, bits))
+
+    def is_full(self):
+        return all(len(self.get(algo)) == RETARGET_WINDOW for algo in ALGOS)
+
+    def first(self, algo):
+        """ the RETARGET_WINDOW-th previous header of that algo, or the
+        earliest one known if there are fewer """
+        d = self.get(algo)
+        return d[0] if d else None
+
+    def count(self, algo):
+        """ number of headers of that algo below height, capped at RETARGET_WINDOW """
+        return len(self.get(algo))
+
+    def dump(self):
+        return dict((algo, list(d)) for algo, d in self.headers.items() if d)
+
+    @classmethod
+    def load(cls, height, state):
+        window = cls(height)
+        for algo, items in state.items():
+            window.get(algo).extend(tuple(item) for item in items)
+        return window
+
+
 class Blockchain(threading.Thread):
 
     def __init__(self, config, network):
@@ -59,24 +226,46 @@ class Blockchain(threading.Thread):
         self.local_height = 0
         self.running = False
         self.headers_url = 'http://myr.electr.us/blockchain_headers'
+        self.bootstrap_aborted = False
+        # the headers file is mapped once and remapped when it grows
+        self.map_lock = threading.Lock()
+        self.headers_map = None
+        self.header_cache = LRUCache(HEADER_CACHE_SIZE)
+        # headers are written through a handle kept open between writes
+        self.file_lock = threading.Lock()
+        self.headers_file = None
+        self.headers_closed = False
+        self.dirty = False
+        self.last_sync = time.time()
+        self.fsync_policy = self.get_fsync_policy()
+        self.pool = None
+        # server -> (chunks, bytes, seconds) of downloaded chunks
+        self.chunk_stats = {}
+        # server -> hash of the last tip it announced
+        self.server_tips = {}
         self.set_local_height()
         self.queue = Queue.Queue()
-        header_db_file = sqlite3.connect(self.db_path())
-        header_db = header_db_file.cursor()
-        try:
-            first_header = header_db.execute('SELECT * FROM headers WHERE height = 0')
-        except Exception:
-            header_db.execute('CREATE TABLE headers (header, algo, height int UNIQUE)')
-        header_db_file.commit()
-        header_db_file.close()
+        self.window = None
 
     
     def height(self):
         return self.local_height
 
 
+    def start(self):
+        # set before the thread runs, so that an early stop is not undone
+        with self.lock: self.running = True
+        threading.Thread.start(self)
+
+
     def stop(self):
         with self.lock: self.running = False
+        # wake up run
+        self.queue.put(None)
+        # the pool is shut down by the thread that uses it
+        if not self.is_alive() or threading.current_thread() is self:
+            self.close_pool()
+        self.close_headers_file()
 
 
     def is_running(self):
@@ -84,12 +273,17 @@ class Blockchain(threading.Thread):
 
 
     def run(self):
+        try:
+            self.run_loop()
+        finally:
+            self.close_pool()
+
+
+    def run_loop(self):
         self.init_headers_file()
         self.set_local_height()
         print_error( "blocks:", self.local_height )
-
-        with self.lock:
-            self.running = True
+        self.get_window(self.local_height + 1)
 
         while self.is_running():
 
@@ -98,14 +292,51 @@ class Blockchain(threading.Thread):
             except Queue.Empty:
                 continue
 
+            # servers announce the same tips: drain the queue and handle
+            # each distinct tip once
+            results = [result]
+            while True:
+                try:
+                    results.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for header, interfaces in self.group_tips(results):
+                if not self.is_running():
+                    break
+                self.process_tip(header, interfaces)
+
+
+    def group_tips(self, results):
+        """ group (interface, header) notifications by tip hash, and
+        record the tip of each server. Returns (header, interfaces)
+        pairs, highest tip first. """
+        tips = {}
+        for result in results:
             if not result: continue
-
             i, header = result
             if not header: continue
-            
-            height = header.get('block_height')
+            _hash = header.hash()
+            self.server_tips[i.server] = _hash
+            if _hash not in tips:
+                tips[_hash] = header, []
+            tips[_hash][1].append(i)
+        return sorted(tips.values(), key=lambda x: -x[0].block_height)
+
+    def get_tip_servers(self, tip_hash):
+        """ servers whose last announced tip is tip_hash """
+        return [server for server, h in self.server_tips.items() if h == tip_hash]
+
+    def process_tip(self, header, interfaces):
+        """ fetch and verify the chain up to header from one of the
+        interfaces that announced it, trying the next one on failure """
+        height = header.block_height
+        for i in interfaces:
 
             if height <= self.local_height:
+                return
+
+            if not i.is_connected:
                 continue
 
             if height > self.local_height + 50:
@@ -124,50 +355,40 @@ class Blockchain(threading.Thread):
                 # verify the chain
                 if self.verify_chain( chain ):
                     print_error("height:", height, i.server)
-                    for header in chain:
-                        self.save_header(header)
+                    self.save_headers(chain)
                 else:
                     print_error("error", i.server)
                     # todo: dismiss that server
                     continue
 
-
             self.network.new_blockchain_height(height, i)
+            return
 
-
-                    
             
     def verify_chain(self, chain):
 
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') -1)
-        
+        prev_header = self.read_header(first_header.block_height -1)
+        self.pow_hashes(chain)
+
         for header in chain:
 
-            height = header.get('block_height')
+            height = header.block_height
 
-            prev_hash = self.hash_header(prev_header)
+            prev_hash = prev_header.hash()
             bits, target = self.get_target(height, chain)
-            version = header.get('version')
-            if version == 2:
-                _hash = self.pow_hash_sha_header(header)
-            elif version == 514:
-                _hash = self.pow_hash_scrypt_header(header)
-            elif version == 1026:
-                _hash = self.pow_hash_groestl_header(header)
-            elif version == 1538:
-                _hash = self.pow_hash_skein_header(header)
-            elif version == 2050:
-                _hash = self.pow_hash_qubit_header(header)
-            else:
+            _hash = header.pow_hash()
+            if _hash is None:
                 print_error( "error unknown block version")
             try:
-                assert prev_hash == header.get('prev_block_hash')
-                assert bits == header.get('bits')
+                assert prev_hash == header.prev_block_hash
+                assert bits == header.bits
                 assert int('0x'+_hash,16) < target
             except Exception:
+                self.window = None
                 return False
 
+            self.window.push(height, header.version, header.timestamp, bits)
             prev_header = header
 
         return True
@@ -184,119 +405,345 @@ class Blockchain(threading.Thread):
         else:
             prev_header = self.read_header(height-1)
             if prev_header is None: raise
-            previous_hash = self.hash_header(prev_header)
-
-        bits, target = self.get_target(height, data=data)
-
-        for i in xrange(num):
-            height = index*2016 + i
-            bits, target = self.get_target(height, data=data)
-            raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
-            version = header.get('version')
-            if version == 2:
-                _hash = self.pow_hash_sha_header(header)
-            elif version == 514:
-                _hash = self.pow_hash_scrypt_header(header)
-            elif version == 1026:
-                _hash = self.pow_hash_groestl_header(header)
-            elif version == 1538:
-                _hash = self.pow_hash_skein_header(header)
-            elif version == 2050:
-                _hash = self.pow_hash_qubit_header(header)
-            else:
-                print_error( "error unknown block version")
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
-            assert int('0x'+_hash,16) < target
+            previous_hash = prev_header.hash()
+
+        headers = [Header(data[i*80:(i+1)*80], height + i) for i in xrange(num)]
+        if headers and previous_hash != headers[0].prev_block_hash:
+            raise ChunkLinkError(index)
+        # below a checkpoint, the hash linkage to the checkpointed header
+        # authenticates the whole chunk
+        checkpoint = self.get_checkpoint(index) if num == 2016 else None
+        if checkpoint is None:
+            # proof of work hashes are independent of each other; linkage
+            # and targets are checked sequentially below
+            self.pow_hashes(headers)
+
+        self.get_window(height)
+        try:
+            for header in headers:
+                height = header.block_height
+                assert previous_hash == header.prev_block_hash
+                if checkpoint is None:
+                    bits, target = self.get_target(height, headers=headers)
+                    _hash = header.pow_hash()
+                    if _hash is None:
+                        print_error( "error unknown block version")
+                    assert bits == header.bits
+                    assert int('0x'+_hash,16) < target
+                else:
+                    bits = header.bits
+
+                # the genesis block counts as sha256d
+                self.window.push(height, header.version if height else ALGO_SHA256D, header.timestamp, bits)
+                previous_hash = header.hash()
 
-            previous_header = header
-            previous_hash = self.hash_header(header)
+            if checkpoint is not None:
+                assert previous_hash == checkpoint
+                if index == len(checkpoints.CHUNK_HASHES) - 1 and checkpoints.RETARGET_STATE:
+                    assert self.window.dump() == checkpoints.RETARGET_STATE
+        except BaseException:
+            self.window = None
+            raise
 
         self.save_chunk(index, data)
         print_error("validated chunk %d"%height)
 
-        
-
-    def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
-
-    def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
+    def get_checkpoint(self, index):
+        """ block hash of the last header of chunk index, if that chunk
+        is checkpointed and full verification was not requested """
+        # values from the system config file are strings
+        if str(self.config.get('full_verification', False)) == 'True':
+            return None
+        if index < len(checkpoints.CHUNK_HASHES):
+            return checkpoints.CHUNK_HASHES[index]
 
-    def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
-
-    def pow_hash_scrypt_header(self, header):
-        return rev_hex(getPoWScryptHash(self.header_to_string(header).decode('hex')).encode('hex'))
+        
 
-    def pow_hash_sha_header(self,header):
-        return self.hash_header(header)
+    def header_to_string(self, header):
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        return header.raw.encode('hex')
 
-    def pow_hash_skein_header(self,header):
-        return rev_hex(getPoWSkeinHash(self.header_to_string(header).decode('hex')).encode('hex'))
 
-    def pow_hash_groestl_header(self,header):
-        return rev_hex(getPoWGroestlHash(self.header_to_string(header).decode('hex')).encode('hex'))
+    def header_from_string(self, s, block_height=None):
+        # s may be a str or a buffer into the headers map
+        return Header(s[:], block_height)
 
-    def pow_hash_qubit_header(self,header):
-        return rev_hex(getPoWQubitHash(self.header_to_string(header).decode('hex')).encode('hex'))
+    def hash_header(self, header):
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        return header.hash()
+
+    def pow_hash_header(self, header):
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        return header.pow_hash()
+
+    def get_pool(self):
+        # off by default: the pool forks the whole client process
+        n = int(self.config.get('verification_workers', 1))
+        if n <= 1:
+            return None
+        if self.pool is None:
+            print_error("starting %d verification workers" % n)
+            self.pool = multiprocessing.Pool(n)
+            self.pool_size = n
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def pow_hashes(self, headers):
+        """ compute and cache the proof of work hashes of a list of
+        headers, in the worker pool if there is one and there are enough
+        headers """
+        headers = [h for h in headers if h._pow_hash is None]
+        use_pool = len(headers) >= POOL_MIN_HEADERS
+        if getPoWScryptHashes is not None:
+            self.scrypt_hashes([h for h in headers if h.version == ALGO_SCRYPT], use_pool)
+            headers = [h for h in headers if h._pow_hash is None]
+        pool = self.get_pool() if use_pool else None
+        raw_headers = [h.raw for h in headers]
+        if pool is None:
+            hashes = map(pow_hash, raw_headers)
+        else:
+            chunksize = max(1, len(raw_headers) / (4 * self.pool_size))
+            hashes = pool.map(pow_hash, raw_headers, chunksize)
+        for h, _hash in zip(headers, hashes):
+            h._pow_hash = _hash
+
+    def scrypt_hashes(self, headers, use_pool=False):
+        """ without ltc_scrypt, hash the scrypt headers together with the
+        batched fallback, split over the worker pool if use_pool is set and
+        there is one. Slices are kept large enough to be batched, unless
+        there are too few headers for a single batch. """
+        if not headers:
+            return
+        raw_headers = [h.raw for h in headers]
+        pool = self.get_pool() if use_pool and len(headers) > 1 else None
+        if pool is None:
+            digests = getPoWScryptHashes(raw_headers)
+        else:
+            num_slices = self.pool_size
+            if len(raw_headers) >= BATCH_MIN_LANES:
+                num_slices = min(num_slices, len(raw_headers) / BATCH_MIN_LANES)
+            num_slices = min(num_slices, len(raw_headers))
+            slices = [raw_headers[i*len(raw_headers)/num_slices:(i+1)*len(raw_headers)/num_slices] for i in range(num_slices)]
+            digests = sum(pool.map(getPoWScryptHashes, slices, 1), [])
+        for h, digest in zip(headers, digests):
+            h._pow_hash = digest[::-1].encode('hex')
 
     def path(self):
         return os.path.join( self.config.path, 'blockchain_headers')
     
-    def db_path(self):
-        return os.path.join(self.config.path, 'headers.db')
-
 
     def init_headers_file(self):
+        """ create the headers file, bootstrapped from headers_url. If the
+        download was interrupted, the marker file records how far it got,
+        and it is resumed on the next start unless the headers file has
+        changed since. """
         filename = self.path()
-        if os.path.exists(filename):
+        marker = filename + '.bootstrap'
+        # the sqlite header store of older versions is replaced by the
+        # in-memory retarget window
+        db_path = os.path.join(self.config.path, 'headers.db')
+        if os.path.exists(db_path):
+            os.unlink(db_path)
+        if not os.path.exists(filename):
+            open(filename,'wb+').close()
+        elif not os.path.exists(marker):
             return
-        
+        else:
+            try:
+                size = int(open(marker).read())
+            except ValueError:
+                size = None
+            if size != os.path.getsize(filename):
+                # headers were added from servers since the bootstrap
+                print_error("headers file changed, bootstrap not resumed")
+                os.unlink(marker)
+                return
+        open(marker, 'w').write(str(os.path.getsize(filename)))
+        if self.bootstrap_headers():
+            os.unlink(marker)
+
+    def bootstrap_headers(self):
+        """ stream the headers file from headers_url chunk by chunk,
+        verifying each chunk while the next ones are downloaded. Returns
+        False if the download was interrupted after some chunks and should
+        be resumed, True if it is done or not worth trying again. """
+        # resume from the last complete chunk
+        size = os.path.getsize(self.path())
+        index = size / 80 / 2016
+        with self.map_lock:
+            if size > index*2016*80:
+                # a mapped file cannot be truncated safely
+                if self.headers_map is not None:
+                    self.headers_map.close()
+                    self.headers_map = None
+                with open(self.path(), 'rb+') as f:
+                    f.truncate(index*2016*80)
+            self.remap_headers()
+        self.header_cache.clear()
+        self.set_local_height()
+        start = index
+
+        self.bootstrap_aborted = False
+        queue = Queue.Queue(BOOTSTRAP_PREFETCH)
+        t = threading.Thread(target=self.download_headers, args=(index*2016*80, queue))
+        t.daemon = True
+        t.start()
+        while True:
+            data = queue.get()
+            if data is None:
+                print_error("headers download interrupted at chunk", index)
+                # without any progress, leave the rest to the servers
+                return index == start
+            if data == '':
+                print_error("headers download done")
+                return True
+            try:
+                self.verify_chunk(index, data.encode('hex'))
+            except BaseException as e:
+                # the rest is requested from servers
+                print_error("bootstrap chunk %d rejected"%index, e)
+                self.bootstrap_aborted = True
+                return True
+            index += 1
+            open(self.path() + '.bootstrap', 'w').write(str(os.path.getsize(self.path())))
+
+    def download_headers(self, offset, queue):
+        """ put the headers file from offset in chunk sized pieces into
+        queue, then '' when done or None if interrupted """
+        import urllib2
+        def put(item):
+            while not self.bootstrap_aborted:
+                try:
+                    queue.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    continue
         try:
-            import urllib, socket
-            socket.setdefaulttimeout(30)
-            print_error("downloading ", self.headers_url )
-            urllib.urlretrieve(self.headers_url, filename)
-            print_error("done.")
-        except Exception:
-            print_error( "download failed. creating file", filename )
-            open(filename,'wb+').close()
+            print_error("downloading", self.headers_url, "from", offset)
+            request = urllib2.Request(self.headers_url)
+            if offset:
+                request.add_header('Range', 'bytes=%d-'%offset)
+            f = urllib2.urlopen(request, timeout=BOOTSTRAP_TIMEOUT)
+            length = f.info().getheader('Content-Length')
+            if offset and f.getcode() != 206:
+                # the server ignored the range: skip to offset
+                skipped = 0
+                while skipped < offset:
+                    s = f.read(min(2016*80, offset - skipped))
+                    if not s:
+                        raise Exception("connection closed at %d"%skipped)
+                    skipped += len(s)
+                end = int(length) if length else None
+            else:
+                end = offset + int(length) if length else None
+            pos = offset
+            while True:
+                data = ''
+                while len(data) < 2016*80:
+                    s = f.read(2016*80 - len(data))
+                    if not s:
+                        break
+                    data += s
+                pos += len(data)
+                if len(data) < 2016*80 and end is not None and pos < end:
+                    raise Exception("connection closed at %d"%pos)
+                if len(data) >= 80 and not put(data[:len(data) - len(data)%80]):
+                    return
+                if len(data) < 2016*80:
+                    break
+            put('')
+        except urllib2.HTTPError as e:
+            # 416: there is nothing after offset
+            put('' if e.code == 416 else None)
+        except Exception as e:
+            print_error("headers download failed", e)
+            put(None)
 
     def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-        self.set_local_height()
+        self.write_headers(index*2016, chunk)
+        self.sync_headers()
 
     def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-        self.set_local_height()
+        self.save_headers([header])
+
+    def save_headers(self, headers):
+        """ write a list of headers sorted by height, with one write per
+        contiguous run """
+        run = []
+        for header in headers:
+            if run and header.block_height != run[-1].block_height + 1:
+                self.write_headers(run[0].block_height, ''.join(h.raw for h in run))
+                run = []
+            run.append(header)
+        if run:
+            self.write_headers(run[0].block_height, ''.join(h.raw for h in run))
+        self.sync_headers()
+
+    def write_headers(self, height, data):
+        with self.file_lock:
+            if self.headers_closed:
+                # stopped while writing: do not leave a handle open
+                with open(self.path(), 'rb+') as f:
+                    f.seek(height*80)
+                    f.write(data)
+            else:
+                if self.headers_file is None:
+                    self.headers_file = open(self.path(), 'rb+')
+                f = self.headers_file
+                f.seek(height*80)
+                f.write(data)
+                # make the data visible to the map before dropping the cache
+                f.flush()
+                self.dirty = True
+        end = height + len(data)/80
+        self.invalidate_headers(height, end)
+        # headers are never truncated, so the height only grows
+        self.local_height = max(self.local_height, end - 1)
+
+    def sync_headers(self):
+        """ fsync the headers file according to the 'headers_fsync'
+        policy: 'chunk' after each chunk or chain, 'never', or a minimum
+        number of seconds between syncs """
+        policy = self.fsync_policy
+        if policy == 'never':
+            return
+        if policy != 'chunk' and time.time() - self.last_sync < policy:
+            return
+        with self.file_lock:
+            if self.headers_file is not None and self.dirty:
+                os.fsync(self.headers_file.fileno())
+                self.dirty = False
+            self.last_sync = time.time()
+
+    def get_fsync_policy(self):
+        """ the 'headers_fsync' option, with the number of seconds as a
+        float; 'chunk' if the option is not valid """
+        policy = self.config.get('headers_fsync', 'chunk')
+        if policy in ['chunk', 'never']:
+            return policy
+        try:
+            return float(policy)
+        except (TypeError, ValueError):
+            print_error("invalid headers_fsync value:", policy)
+            return 'chunk'
+
+    def close_headers_file(self):
+        with self.file_lock:
+            self.headers_closed = True
+            if self.headers_file is not None:
+                if self.dirty and self.fsync_policy != 'never':
+                    os.fsync(self.headers_file.fileno())
+                self.headers_file.close()
+                self.headers_file = None
+                self.dirty = False
 
 
     def set_local_height(self):
@@ -308,88 +755,69 @@ class Blockchain(threading.Thread):
 
 
     def read_header(self, block_height):
+        if block_height < 0:
+            return
+        h = self.header_cache.get(block_height)
+        if h is not None:
+            return h
+        offset = block_height*80
+        with self.map_lock:
+            if self.headers_map is None or offset + 80 > len(self.headers_map):
+                self.remap_headers()
+            if self.headers_map is None or offset + 80 > len(self.headers_map):
+                return
+            h = Header(self.headers_map[offset:offset+80], block_height)
+            self.header_cache.put(block_height, h)
+        return h
+
+    def invalidate_headers(self, start, end):
+        # drop overwritten headers; holding map_lock ensures that a
+        # concurrent read_header cannot cache the old value afterwards
+        with self.map_lock:
+            for height in xrange(start, end):
+                self.header_cache.pop(height)
+
+    def remap_headers(self):
+        # called with map_lock held
+        if self.headers_map is not None:
+            self.headers_map.close()
+            self.headers_map = None
         name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h 
+        if not os.path.exists(name) or os.path.getsize(name) == 0:
+            return
+        with open(name, 'rb') as f:
+            self.headers_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
-    def get_target(self, height, chain=None, data=None):
+    def get_target(self, height, chain=None, headers=None):
         if chain is None:
             chain = []  # Do not use mutables as default values!
 
-        header_db_file = sqlite3.connect(self.db_path())
-        header_db = header_db_file.cursor()
         max_target = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
-        if height == 0 and data: 
-            header_db.execute('''INSERT OR REPLACE INTO headers VALUES ('%s', '%s', '%s')''' % (data[0:80].encode('hex'), str(2), str(0)))
-            header_db_file.commit()
-            header_db_file.close()
         if height == 0: return 0x1e0fffff, 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
 
         # Myriadcoin
-        if height < 10:
-            first = self.read_header(0)
+        if headers:
+            last = headers[height % 2016]
         else:
-            first = self.read_header(height-10)
-        last = self.read_header(height-1)
-
-        if not data and chain:
+            last = self.read_header(height-1)
             for h in chain:
-                if h.get('block_height') == height:
+                if h.block_height == height:
                     last = h
-            try:
-                header_db.execute('''INSERT OR REPLACE INTO headers VALUES ('%s', '%s', '%s')''' % (self.header_to_string(last), str(last.get('version')), str(height)))
-                header_db_file.commit()
-                select = header_db.execute('''SELECT header from headers where algo = '%s' and height < '%s' ORDER BY height DESC LIMIT 10''' % (last.get('version'), str(height))).fetchall()[-1][0]
-                first = self.header_from_string(select.decode('hex'))
-            except Exception, e:
-                print_error('exception: ', e)
-            
 
-        if data:
-            m = height % 2016
-            h_to_insert = data[m*80:(m+1)*80].encode('hex')
-            try:
-                header_db.execute('''INSERT OR REPLACE INTO headers VALUES ('%s', '%s', '%s')''' % (h_to_insert, str(self.header_from_string(h_to_insert.decode('hex')).get('version')), str(height)))
-                header_db_file.commit()
-            except Exception, e:
-                print_error('exception: ', e)
-            if m >= 10:
-                raw_header = data[(m-10)*80:(m-9)*80]
-                first = self.header_from_string(raw_header)
-                raw_l_header = data[m*80:(m+1)*80]
-                last = self.header_from_string(raw_l_header)
-                try:
-                    select = header_db.execute('''SELECT header from headers where algo = '%s' and height < '%s' ORDER BY height DESC LIMIT 10''' % (last.get('version'), height)).fetchall()[-1][0]
-                    first = self.header_from_string(select.decode('hex'))
-                except Exception, e:
-                    
-                    print_error('select error: ', e)
-            elif height < 10:
-                raw_header = data[0:80]
-                first = self.header_from_string(raw_header)
-                raw_l_header = data[m*80:(m+1)*80]
-                last = self.header_from_string(raw_l_header)
-            else:
-                first = self.read_header(height - 10)
-                raw_l_header = data[m*80:(m+1)*80]
-                last = self.header_from_string(raw_l_header)
-            
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        window = self.get_window(height)
+        algo = last.version
+        first = window.first(algo)
+        first_timestamp = first[1] if first else last.timestamp
+
+        nActualTimespan = last.timestamp - first_timestamp
         nTargetTimespan = 30*5
         nAvgInterval = 10*nTargetTimespan
 
         numheaders = 10
         #shouldn't need this after a while, assume 10K is enough:
         if height < 10000:
-            numheaders = header_db.execute('''SELECT count(*) from headers where algo = '%s' and height < '%s' ''' % (last.get('version'),height)).fetchone()[0]
-            print_error('height, numheaders', height, numheaders)
+            numheaders = window.count(algo)
 
         if numheaders >= 10:
             #seems to be a bug based on what the myriadcoind code says... will check later
@@ -401,7 +829,7 @@ class Blockchain(threading.Thread):
             return 0x1e0fffff, 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
 
 
-        bits = last.get('bits') 
+        bits = last.bits
         # convert to bignum
         MM = 256*256*256
         a = bits%MM
@@ -425,79 +853,260 @@ class Blockchain(threading.Thread):
             i += 1
 
         new_bits = c + MM * i
-        header_db_file.commit()
-        header_db_file.close()
         return new_bits, new_target
 
 
-    def request_header(self, i, h, queue):
-        print_error("requesting header %d from %s"%(h, i.server))
-        i.send_request({'method':'blockchain.block.get_header', 'params':[h]}, queue)
-
-    def retrieve_request(self, queue):
-        while True:
+    def get_window(self, height):
+        """ return the retarget window for the headers below height. It is
+        moved forward by verify_chunk and verify_chain, and only rebuilt
+        from the headers file when it is not at that height. """
+        if self.window is not None and self.window.height == height:
+            return self.window
+        if checkpoints.RETARGET_STATE and height == len(checkpoints.CHUNK_HASHES)*2016:
+            self.window = AlgoWindow.load(height, checkpoints.RETARGET_STATE)
+            return self.window
+        window = AlgoWindow(height)
+        # below 10000 the number of headers of each algo matters, so scan
+        # down to the genesis block if needed
+        stop = 0 if height < 10000 else height - 2016
+        h = height - 1
+        while h >= stop and not window.is_full():
+            header = self.read_header(h)
+            if header is None:
+                break
+            algo = header.version if h else ALGO_SHA256D
+            window.push_front(h, algo, header.timestamp, header.bits)
+            h -= 1
+        self.window = window
+        return window
+
+    def get_headers(self, i, heights, queue):
+        """ headers of interface i at the given heights, or None if the
+        server does not answer. The requests are sent together, as a batch
+        if the interface batches them, so that they take a single round
+        trip. """
+        print_error("requesting %d headers from %s"%(len(heights), i.server))
+        i.send_requests([{'method':'blockchain.block.get_header', 'params':[h]} for h in heights], queue)
+        headers = {}
+        for h in heights:
             try:
-                ir = queue.get(timeout=1)
+                _, r = queue.get(timeout=CHUNK_TIMEOUT)
             except Queue.Empty:
-                print_error('blockchain: request timeout')
-                continue
-            i, r = ir
-            result = r['result']
-            return result
+                print_error('blockchain: request timeout', i.server)
+                return
+            result = r.get('result')
+            if not result:
+                return
+            header = Header.from_dict(result)
+            headers[header.block_height] = header
+        return headers
+
+    def get_chunks(self, i, indexes, queue):
+        """ headers of the given chunks of interface i, or None """
+        print_error("requesting chunks %d-%d from %s"%(indexes[0], indexes[-1], i.server))
+        i.send_requests([{'method':'blockchain.block.get_chunk', 'params':[index]} for index in indexes], queue)
+        headers = {}
+        for index in indexes:
+            try:
+                _, r = queue.get(timeout=CHUNK_TIMEOUT)
+            except Queue.Empty:
+                print_error('blockchain: request timeout', i.server)
+                return
+            result = r.get('result')
+            if not result:
+                return
+            data = result.decode('hex')
+            height = r['params'][0]*2016
+            for k in xrange(len(data)/80):
+                headers[height + k] = Header(data[k*80:(k+1)*80], height + k)
+        return headers
+
+    def get_header_range(self, i, start, end, queue):
+        """ headers of interface i from start to end included. Long
+        ranges are requested as chunks. """
+        if end - start + 1 > HEADER_BATCH:
+            headers = self.get_chunks(i, range(start/2016, end/2016 + 1), queue)
+        else:
+            headers = self.get_headers(i, range(start, end + 1), queue)
+        if headers is None:
+            return
+        return dict((h, headers[h]) for h in range(start, end + 1) if h in headers)
+
+    def find_fork(self, i, height, remote, queue):
+        """ highest height not above height where the chain of interface
+        i matches ours, found with a few rounds of batched bisection.
+        The headers fetched on the way are added to remote. """
+        lo, hi = -1, height
+        # first round: the heights just below the tip, then exponentially
+        # further back, as most reorgs are short
+        probes = [hi - (1 << k) + 1 for k in range(HEADER_PROBES)]
+        while hi > lo:
+            probes = sorted(set(h for h in probes if lo < h <= hi))
+            headers = self.get_headers(i, probes, queue)
+            if headers is None:
+                return
+            remote.update(headers)
+            # a header also tells the hash of its predecessor
+            hashes = dict((x - 1, header.prev_block_hash) for x, header in remote.items())
+            hashes.update((x, header.hash()) for x, header in remote.items())
+            for h in sorted(x for x in hashes if lo < x <= hi):
+                if self.read_header(h).hash() == hashes[h]:
+                    lo = h
+                else:
+                    hi = h - 1
+                    break
+            # next rounds: evenly spaced between the bounds
+            step = max(1, (hi - lo) / (HEADER_PROBES + 1))
+            probes = range(lo + step, hi + 1, step)[:HEADER_PROBES]
+        return lo
 
     def get_chain(self, interface, final_header):
-
-        header = final_header
-        chain = [ final_header ]
-        requested_header = False
+        """ the headers of interface from the fork point with our chain
+        up to final_header, or None if they could not be retrieved """
+        height = final_header.block_height
         queue = Queue.Queue()
 
-        while self.is_running():
+        # fast path: the tip extends our chain
+        previous_header = self.read_header(height - 1)
+        if previous_header and previous_header.hash() == final_header.prev_block_hash:
+            return [final_header]
 
-            if requested_header:
-                header = self.retrieve_request(queue)
-                if not header: return
-                chain = [ header ] + chain
-                requested_header = False
-
-            height = header.get('block_height')
-            previous_header = self.read_header(height -1)
-            if not previous_header:
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
-
-            # verify that it connects to my chain
-            prev_hash = self.hash_header(previous_header)
-            if prev_hash != header.get('prev_block_hash'):
-                print_error("reorg")
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
-
-            else:
-                # the chain is complete
-                return chain
+        remote = {}
+        top = min(height - 1, self.local_height)
+        if previous_header:
+            print_error("reorg")
+        else:
+            # fetch the headers missing above our height at once
+            remote = self.get_header_range(interface, top + 1, height - 1, queue)
+            if remote is None:
+                return
+            below = remote.get(top + 1)
+            if below and self.read_header(top) and self.read_header(top).hash() == below.prev_block_hash:
+                top = None
+
+        if top is not None:
+            fork = self.find_fork(interface, top, remote, queue)
+            if fork is None:
+                return
+            missing = [h for h in range(fork + 1, height) if h not in remote]
+            if missing:
+                headers = self.get_header_range(interface, missing[0], missing[-1], queue)
+                if headers is None:
+                    return
+                remote.update(headers)
+        else:
+            fork = self.local_height
 
+        chain = [remote.get(h) for h in range(fork + 1, height)]
+        if None in chain:
+            return
+        return chain + [final_header]
+
+
+    def request_chunk(self, i, index, queue, pending):
+        print_error( "Requesting chunk:", index, i.server )
+        i.send_request({'method':'blockchain.block.get_chunk', 'params':[index]}, queue)
+        pending[index] = i, time.time()
+
+    def get_chunk_interfaces(self, i, height):
+        """ connected interfaces that can serve chunks up to height,
+        starting with the one that announced it """
+        interfaces = [i] if i.is_connected else []
+        if self.network:
+            interfaces += [x for x in self.network.get_chunk_interfaces(height) if x is not i]
+        return interfaces
+
+    def pick_interface(self, interfaces, pending, excluded):
+        """ the least busy server, preferring the fastest ones, among
+        those that did not already fail this chunk """
+        candidates = [x for x in interfaces if x.server not in excluded] or interfaces
+        busy = collections.Counter(x.server for x, _ in pending.values())
+        def key(x):
+            chunks, size, seconds = self.chunk_stats.get(x.server, (0, 0, 0))
+            return busy[x.server], -(size/seconds if seconds else 0)
+        return min(candidates, key=key)
+
+    def record_chunk(self, server, size, seconds):
+        chunks, total_size, total_seconds = self.chunk_stats.get(server, (0, 0, 0))
+        self.chunk_stats[server] = chunks + 1, total_size + size, total_seconds + seconds
 
     def get_and_verify_chunks(self, i, header, height):
-
+        """ download the chunks from the current local height up to height.
+        Requests are spread over all connected servers that have reached
+        height, with up to chunk_prefetch outstanding per server while
+        earlier chunks are being verified; chunks are saved in order. A
+        chunk that times out or fails verification is requested again
+        from another server. If a chunk does not connect to the local
+        chain, the chunk below it is downloaded again first. """
         queue = Queue.Queue()
         min_index = (self.local_height + 1)/2016
         max_index = (height + 1)/2016
+        prefetch = max(1, int(self.config.get('chunk_prefetch', CHUNK_PREFETCH)))
+        chunks = {}
+        pending = {}
+        retries = collections.defaultdict(int)
+        failed_by = collections.defaultdict(set)
+        next_index = min_index
         n = min_index
         while n < max_index + 1:
-            print_error( "Requesting chunk:", n )
-            i.send_request({'method':'blockchain.block.get_chunk', 'params':[n]}, queue)
-            r = self.retrieve_request(queue)
-            try:
-                self.verify_chunk(n, r)
-                n = n + 1
-            except Exception:
-                print_error('Verify chunk failed!')
-                n = n - 1
-                if n < 0:
-                    return False
+            if not self.is_running():
+                return False
+            interfaces = self.get_chunk_interfaces(i, height)
+            if not interfaces:
+                return False
+            window = prefetch * len(interfaces)
+            while next_index < max_index + 1 and next_index < n + window:
+                x = self.pick_interface(interfaces, pending, failed_by[next_index])
+                self.request_chunk(x, next_index, queue, pending)
+                next_index += 1
+
+            if n not in chunks:
+                request = pending.get(n)
+                timeout = CHUNK_TIMEOUT - (time.time() - request[1]) if request else CHUNK_TIMEOUT
+                try:
+                    source, r = queue.get(timeout=max(0, timeout))
+                    index, result = r['params'][0], r.get('result')
+                except Queue.Empty:
+                    source = request[0] if request else i
+                    print_error('chunk request timeout', n, source.server)
+                    index, result = n, None
+                request = pending.get(index)
+                if request and request[0] is source:
+                    pending.pop(index)
+                    if result:
+                        self.record_chunk(source.server, len(result)/2, time.time() - request[1])
+                if index < n:
+                    # late answer for a chunk that is already verified
+                    continue
+                if result:
+                    chunks[index] = source, result
+                    continue
+                failed = index
+            else:
+                source, data = chunks.pop(n)
+                try:
+                    self.verify_chunk(n, data)
+                    n = n + 1
+                    continue
+                except ChunkLinkError:
+                    # the local chunk below is on another branch: step
+                    # back and fetch it again before this one
+                    print_error('chunk does not connect to local chain', n, source.server)
+                    failed = n
+                    if n > 0:
+                        n = n - 1
+                        x = self.pick_interface(interfaces, pending, failed_by[n])
+                        self.request_chunk(x, n, queue, pending)
+                except Exception:
+                    print_error('Verify chunk failed!', n, source.server)
+                    failed = n
+
+            # ask another server for a chunk that failed
+            retries[failed] += 1
+            failed_by[failed].add(source.server)
+            if retries[failed] > CHUNK_RETRIES:
+                return False
+            x = self.pick_interface(interfaces, pending, failed_by[failed])
+            self.request_chunk(x, failed, queue, pending)
 
         return True
-
@@ -0,0 +1,19 @@
+# Header checkpoints, generated by scripts/make_checkpoints from a
+# blockchain_headers file whose chunks it verified in full. Do not edit
+# by hand.
+#
+# Chunks whose last header is checkpointed are verified by hash linkage
+# only; proof of work is not checked below the last checkpoint unless
+# the 'full_verification' config option is set.
+#
+# The tables below are empty until they are generated, so checkpoints
+# are off and every chunk has its proof of work checked.
+
+# block hash of the last header of each chunk, by chunk index
+CHUNK_HASHES = [
+]
+
+# retarget window of each algo below the last checkpoint:
+# algo -> [(height, timestamp, bits), ...]
+RETARGET_STATE = {
+}
@@ -75,6 +75,7 @@ register_command('freeze',               1, 1, False, True,  True,  'Freeze the
 register_command('getbalance',           0, 1, True,  True,  False, 'Return the balance of your wallet, or of one account in your wallet', 'getbalance [<account>]')
 register_command('getservers',           0, 0, True,  False, False, 'Return the list of available servers')
 register_command('getversion',           0, 0, False, False, False, 'Return the version of your client', 'getversion')
+register_command('getverifierstatus',    0, 0, True,  True,  False, 'Return the counters of SPV verification: pending, failed and verified proofs, and their latency', 'getverifierstatus')
 register_command('getaddressbalance',    1, 1, True,  False, False, 'Return the balance of an address', 'getaddressbalance <address>')
 register_command('getaddresshistory',    1, 1, True,  False, False, 'Return the transaction history of a wallet address', 'getaddresshistory <address>')
 register_command('getconfig',            1, 1, False, False, False, 'Return a configuration variable', 'getconfig <name>')
@@ -241,6 +242,9 @@ class Commands:
         import electrum_myr as electrum   # Needs to stay here to prevent ciruclar imports
         return electrum.ELECTRUM_VERSION
 
+    def getverifierstatus(self):
+        return self.wallet.verifier.get_status()
+
     def getmpk(self):
         return self.wallet.get_master_public_keys()
 
@@ -27,6 +27,7 @@ import Queue
 
 import util
 from network import Network
+from interface import BATCH_SIZE
 from util import print_error, print_stderr, parse_json
 from simple_config import SimpleConfig
 
@@ -69,6 +70,8 @@ class ClientThread(threading.Thread):
         self.server = server
         self.daemon = True
         self.client_pipe = util.SocketPipe(s)
+        self.client_pipe.set_timeout(None)
+        # responses, and None when the client is gone
         self.response_queue = Queue.Queue()
         self.server.add_client(self)
 
@@ -80,8 +83,9 @@ class ClientThread(threading.Thread):
                 continue
             if request is None:
                 self.running = False
+                self.response_queue.put(None)
                 break
-            if request.get('method') == 'daemon.stop':
+            if type(request) is dict and request.get('method') == 'daemon.stop':
                 self.server.stop()
                 continue
             self.server.send_request(self, request)
@@ -90,12 +94,19 @@ class ClientThread(threading.Thread):
         self.running = True
         threading.Thread(target=self.reading_thread).start()
         while self.running:
-            try:
-                response = self.response_queue.get(timeout=0.1)
-            except Queue.Empty:
+            response = self.response_queue.get()
+            if response is None:
                 continue
+            responses = [response]
+            while True:
+                try:
+                    r = self.response_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if r is not None:
+                    responses.append(r)
             try:
-                self.client_pipe.send(response)
+                self.client_pipe.send_all(responses, self.server.batch_size)
             except socket.error:
                 self.running = False
                 break
@@ -123,6 +134,7 @@ class NetworkServer(threading.Thread):
         self.clients = []
         self.request_id = 0
         self.requests = {}
+        self.batch_size = int(config.get('batch_size', BATCH_SIZE))
 
     def is_running(self):
         with self.lock:
@@ -131,6 +143,8 @@ class NetworkServer(threading.Thread):
     def stop(self):
         with self.lock:
             self.running = False
+        # wake up run
+        self.network_queue.put(None)
 
     def start(self):
         self.running = True
@@ -150,10 +164,13 @@ class NetworkServer(threading.Thread):
             print_error("client quit:", len(self.clients))
 
     def send_request(self, client, request):
+        """ forward a request, or a JSON-RPC batch array of requests, to
+        the network """
         with self.lock:
-            self.request_id += 1
-            self.requests[self.request_id] = (request['id'], client)
-            request['id'] = self.request_id
+            for r in (request if type(request) is list else [request]):
+                self.request_id += 1
+                self.requests[self.request_id] = (r['id'], client)
+                r['id'] = self.request_id
 
         if self.debug:
             print_error("-->", request)
@@ -163,9 +180,8 @@ class NetworkServer(threading.Thread):
     def run(self):
         self.network.start(self.network_queue)
         while self.is_running():
-            try:
-                response = self.network_queue.get(timeout=0.1)
-            except Queue.Empty:
+            response = self.network_queue.get()
+            if response is None:
                 continue
             if self.debug:
                 print_error("<--", response)
@@ -33,6 +33,11 @@ from simple_config import SimpleConfig
 import x509
 
 DEFAULT_TIMEOUT = 5
+# requests sent in one JSON-RPC batch array between clients and the
+# daemon; the 'batch_size' config option overrides it, and 1 disables
+# batches. Servers only get batches if 'server_batch_size' is set, as
+# not all of them support them.
+BATCH_SIZE = 100
 proxy_modes = ['socks4', 'socks5', 'http']
 
 
@@ -61,6 +66,7 @@ class TcpInterface(threading.Thread):
         self.debug = False # dump network messages. can be changed at runtime using the console
         self.message_id = 0
         self.unanswered_requests = {}
+        self.batch_size = int(self.config.get('server_batch_size', 1))
         # are we waiting for a pong?
         self.is_ping = False
         # parse server
@@ -255,21 +261,25 @@ class TcpInterface(threading.Thread):
         
 
     def send_request(self, request, queue=None):
-        _id = request.get('id')
-        method = request.get('method')
-        params = request.get('params')
+        self.send_requests([request], queue)
+
+    def send_requests(self, requests, queue=None):
+        """ send requests in JSON-RPC batch arrays of up to batch_size """
         with self.lock:
+            out = []
+            for i, request in enumerate(requests):
+                out.append({'id':self.message_id + i, 'method':request.get('method'), 'params':request.get('params')})
             try:
-                r = {'id':self.message_id, 'method':method, 'params':params}
-                self.pipe.send(r)
+                self.pipe.send_all(out, self.batch_size)
                 if self.debug:
-                    print_error("-->", r)
+                    print_error("-->", out)
             except socket.error, e:
                 print_error("socked error:", self.server, e)
                 self.is_connected = False
                 return
-            self.unanswered_requests[self.message_id] = method, params, _id, queue
-            self.message_id += 1
+            for request, r in zip(requests, out):
+                self.unanswered_requests[r['id']] = r['method'], r['params'], request.get('id'), queue
+            self.message_id += len(out)
 
     def parse_proxy_options(self, s):
         if type(s) == type({}): return s  # fixme: type should be fixed
@@ -315,7 +325,7 @@ class TcpInterface(threading.Thread):
         t = 0
         while self.is_connected:
             # ping the server with server.version
-            if time.time() - t > 60:
+            if time.time() - t >= 60:
                 if self.is_ping:
                     print_error("ping timeout", self.server)
                     self.is_connected = False
@@ -324,6 +334,8 @@ class TcpInterface(threading.Thread):
                     self.send_request({'method':'server.version', 'params':[ELECTRUM_VERSION, PROTOCOL_VERSION]})
                     self.is_ping = True
                     t = time.time()
+            # wait for a response until the next ping is due
+            self.pipe.set_timeout(max(0.1, t + 60 - time.time()))
             try:
                 response = self.pipe.get()
             except util.timeout:
@@ -331,7 +343,12 @@ class TcpInterface(threading.Thread):
             if response is None:
                 self.is_connected = False
                 break
-            self.process_response(response)
+            # the answer to a batch is an array
+            if type(response) is list:
+                for r in response:
+                    self.process_response(r)
+            else:
+                self.process_response(response)
 
         self.change_status()
         print_error("closing connection:", self.server)
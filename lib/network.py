@@ -2,7 +2,7 @@ import threading, time, Queue, os, sys, shutil, random
 from util import user_dir, appdata_dir, print_error, print_msg
 from bitcoin import *
 import interface
-from blockchain import Blockchain
+from blockchain import Blockchain, Header
 
 DEFAULT_PORTS = {'t':'50008', 's':'50009', 'h':'8088', 'g':'8089'}
 
@@ -14,6 +14,9 @@ DEFAULT_SERVERS = {
 }
 
 DISCONNECTED_RETRY_INTERVAL = 60
+# seconds between attempts to start interfaces while there are fewer
+# than num_server
+START_INTERFACES_INTERVAL = 10
 
 
 def parse_servers(result):
@@ -129,10 +132,10 @@ class Network(threading.Thread):
         return self.interface and self.interface.is_connected
 
     def send_subscriptions(self):
-        for addr in self.addresses:
-            self.interface.send_request({'method':'blockchain.address.subscribe', 'params':[addr]})
-        self.interface.send_request({'method':'server.banner','params':[]})
-        self.interface.send_request({'method':'server.peers.subscribe','params':[]})
+        requests = [{'method':'blockchain.address.subscribe', 'params':[addr]} for addr in self.addresses]
+        requests.append({'method':'server.banner','params':[]})
+        requests.append({'method':'server.peers.subscribe','params':[]})
+        self.interface.send_requests(requests)
 
     def get_status_value(self, key):
         if key == 'status':
@@ -198,6 +201,7 @@ class Network(threading.Thread):
         server = self.random_server()
         if server:
             self.start_interface(server)
+        return server
 
     def start_interfaces(self):
         self.interface = self.start_interface(self.default_server)
@@ -327,13 +331,23 @@ class Network(threading.Thread):
 
     def process_requests_thread(self):
         while self.is_running():
-            try:
-                request = self.requests_queue.get(timeout=0.1)
-            except Queue.Empty:
+            request = self.requests_queue.get()
+            if request is None:
+                # woken up by stop
                 continue
-            self.process_request(request)
+            # clients send JSON-RPC batch arrays
+            self.process_requests(request if type(request) is list else [request])
+
+    def process_requests(self, requests):
+        """ answer the requests that do not need a server, and forward
+        the other ones to the main interface together """
+        forward = [request for request in requests if not self.process_request(request)]
+        if forward:
+            self.interface.send_requests(forward)
 
     def process_request(self, request):
+        """ answer a request locally. Returns False if it must be sent
+        to the server. """
         method = request['method']
         params = request['params']
         _id = request['id']
@@ -351,41 +365,60 @@ class Network(threading.Thread):
                 print_error("network error", str(e))
 
             self.response_queue.put(out)
-            return
+            return True
 
         if method == 'blockchain.address.subscribe':
             addr = params[0]
             if addr in self.addresses:
                 self.response_queue.put({'id':_id, 'result':self.addresses[addr]}) 
-                return
+                return True
 
-        self.interface.send_request(request)
+        return False
 
 
+    def maintain_interfaces(self):
+        """ start interfaces up to num_server, and retry connections.
+        Returns the time at which it must be called again, or None if
+        only a change of the interfaces makes it necessary. """
+        while len(self.interfaces) + len(self.pending_servers) < self.num_server:
+            if not self.start_random_interface():
+                break
+        if not self.interfaces:
+            if time.time() - self.disconnected_time >= DISCONNECTED_RETRY_INTERVAL:
+                print_error('network: retrying connections')
+                self.disconnected_servers = set([])
+                self.disconnected_time = time.time()
+
+        if not self.interface.is_connected:
+            if time.time() - self.disconnected_time >= DISCONNECTED_RETRY_INTERVAL:
+                print_error("forcing reconnection")
+                self.queue.put((self.interface, None))
+                self.disconnected_time = time.time()
+
+        if not self.interfaces or not self.interface.is_connected:
+            return self.disconnected_time + DISCONNECTED_RETRY_INTERVAL
+        if len(self.interfaces) + len(self.pending_servers) < self.num_server:
+            return time.time() + START_INTERFACES_INTERVAL
+
     def run(self):
+        next_check = self.maintain_interfaces()
         while self.is_running():
+            timeout = max(0, next_check - time.time()) if next_check is not None else None
             try:
-                i, response = self.queue.get(timeout=0.1)
+                i, response = self.queue.get(timeout=timeout)
             except Queue.Empty:
+                next_check = self.maintain_interfaces()
+                continue
 
-                if len(self.interfaces) + len(self.pending_servers) < self.num_server:
-                    self.start_random_interface()
-                if not self.interfaces:
-                    if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
-                        print_error('network: retrying connections')
-                        self.disconnected_servers = set([])
-                        self.disconnected_time = time.time()
-
-                if not self.interface.is_connected:
-                    if time.time() - self.disconnected_time > DISCONNECTED_RETRY_INTERVAL:
-                        print_error("forcing reconnection")
-                        self.queue.put((self.interface, None))
-                        self.disconnected_time = time.time()
-
+            if i is None:
+                # woken up by stop
                 continue
-            
+
             if response is not None:
                 self.process_response(i, response)
+                if response['method'] == 'server.peers.subscribe':
+                    # peers that were not known at startup
+                    next_check = self.maintain_interfaces()
                 continue
 
             # if response is None it is a notification about the interface
@@ -420,6 +453,7 @@ class Network(threading.Thread):
                         else:
                             self.interface = self.start_interface(self.default_server)
 
+            next_check = self.maintain_interfaces()
 
         print_error("Network: Stopping interfaces")
         for i in self.interfaces.values():
@@ -433,11 +467,16 @@ class Network(threading.Thread):
         height = result.get('block_height')
         if not height:
             return
+        try:
+            header = Header.from_dict(result)
+        except BaseException as e:
+            print_error("invalid header from", i.server, str(e))
+            return
         self.heights[i.server] = height
         self.merkle_roots[i.server] = result.get('merkle_root')
         self.utxo_roots[i.server] = result.get('utxo_root')
         # notify blockchain about the new height
-        self.blockchain.queue.put((i,result))
+        self.blockchain.queue.put((i, header))
 
         if i == self.interface:
             if self.server_is_lagging() and self.config.get('auto_cycle'):
@@ -464,13 +503,26 @@ class Network(threading.Thread):
         print_error("stopping network")
         with self.lock:
             self.running = False
+        # wake up run and process_requests_thread
+        self.queue.put((None, None))
+        self.requests_queue.put(None)
+        self.blockchain.stop()
 
     def is_running(self):
         with self.lock:
             return self.running
 
+    def get_chunk_interfaces(self, height):
+        """ connected interfaces whose server has reached height """
+        return [i for i in self.interfaces.values() if i.is_connected and self.heights.get(i.server, 0) >= height]
+
+    def get_chunk_stats(self):
+        return self.blockchain.chunk_stats
+
     def get_header(self, tx_height):
-        return self.blockchain.read_header(tx_height)
+        # sent to clients as json, like the headers of the servers
+        header = self.blockchain.read_header(tx_height)
+        return header.as_dict() if header else None
 
     def get_local_height(self):
         return self.blockchain.height()
@@ -30,6 +30,7 @@ from network import Network
 from util import print_error, print_stderr, parse_json
 from simple_config import SimpleConfig
 from daemon import NetworkServer, DAEMON_PORT
+from interface import BATCH_SIZE
 
 
 
@@ -44,6 +45,7 @@ class NetworkProxy(threading.Thread):
         self.message_id = 0
         self.unanswered_requests = {}
         self.subscriptions = {}
+        self.batch_size = int(self.config.get('batch_size', BATCH_SIZE))
         self.debug = False
         self.lock = threading.Lock()
         self.pending_transactions_for_notifications = []
@@ -61,6 +63,8 @@ class NetworkProxy(threading.Thread):
             for key in ['status','banner','updated','servers','interfaces']:
                 value = self.network.get_status_value(key)
                 self.pipe.get_queue.put({'method':'network.status', 'params':[key, value]})
+        # run blocks until a response arrives, and stop wakes it up
+        self.pipe.set_timeout(None)
 
         # status variables
         self.status = 'connecting'
@@ -81,7 +85,12 @@ class NetworkProxy(threading.Thread):
                 continue
             if response is None:
                 break
-            self.process(response)
+            # the daemon answers batches with arrays
+            if type(response) is list:
+                for r in response:
+                    self.process(r)
+            else:
+                self.process(response)
 
         self.trigger_callback('stop')
         if self.network:
@@ -110,9 +119,11 @@ class NetworkProxy(threading.Thread):
         msg_id = response.get('id')
         result = response.get('result')
         error = response.get('error')
+        up_to_date = False
         if msg_id is not None:
             with self.lock:
                 method, params, callback = self.unanswered_requests.pop(msg_id)
+                up_to_date = not self.unanswered_requests
         else:
             method = response.get('method')
             params = response.get('params')
@@ -128,6 +139,8 @@ class NetworkProxy(threading.Thread):
         
         r = {'method':method, 'params':params, 'result':result, 'id':msg_id, 'error':error}
         callback(r)
+        if up_to_date:
+            self.trigger_callback('up_to_date')
 
 
     def send(self, messages, callback):
@@ -160,7 +173,7 @@ class NetworkProxy(threading.Thread):
                     print_error("-->", request)
                 self.message_id += 1
 
-            self.pipe.send_all(requests)
+            self.pipe.send_all(requests, self.batch_size)
             return ids
 
 
@@ -215,6 +228,14 @@ class NetworkProxy(threading.Thread):
 
     def stop(self):
         self.running = False
+        # wake up run
+        if self.network:
+            self.pipe.get_queue.put(None)
+        else:
+            try:
+                self.pipe.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
     def stop_daemon(self):
         return self.send([('daemon.stop',[])], None)
@@ -225,6 +246,11 @@ class NetworkProxy(threading.Thread):
                 self.callbacks[event] = []
             self.callbacks[event].append(callback)
 
+    def unregister_callback(self, event, callback):
+        with self.lock:
+            if callback in self.callbacks.get(event, []):
+                self.callbacks[event].remove(callback)
+
     def trigger_callback(self, event):
         with self.lock:
             callbacks = self.callbacks.get(event,[])[:]
@@ -18,6 +18,19 @@
 
 import hashlib
 import hmac
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# headers hashed together by scrypt_1024_1_1_80_batch; each lane needs a
+# 128 KiB V table
+BATCH_LANES = 256
+# below this many lanes the numpy overhead outweighs the gain, and the
+# headers are hashed one at a time
+BATCH_MIN_LANES = 50
 
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, str) or len(header) != 80:
@@ -58,6 +71,82 @@ def scrypt_1024_1_1_80(header):
     mac.update(''.join(B))
     return mac.digest()
 
+def scrypt_1024_1_1_80_batch(headers):
+    """ scrypt hashes of a list of 80-byte headers. With numpy, the
+    headers are hashed together, one lane of uint32 arrays per header;
+    otherwise, or if there are too few of them, they are hashed one at a
+    time. Batches are of even size, so none is smaller than needed. """
+    if numpy is None or len(headers) < BATCH_MIN_LANES:
+        return map(scrypt_1024_1_1_80, headers)
+    num_batches = (len(headers) + BATCH_LANES - 1) / BATCH_LANES
+    hashes = []
+    for i in xrange(num_batches):
+        start = i * len(headers) / num_batches
+        end = (i + 1) * len(headers) / num_batches
+        hashes += _scrypt_batch(headers[start:end])
+    return hashes
+
+
+def _scrypt_batch(headers):
+    for header in headers:
+        if not isinstance(header, str) or len(header) != 80:
+            raise ValueError('header must be an 80-byte string')
+    n = len(headers)
+    macs = [hmac.new(header, digestmod=hashlib.sha256) for header in headers]
+
+    # X[j] holds word j of every lane
+    B = ''
+    for header, mac in zip(headers, macs):
+        for i in xrange(4):
+            m = mac.copy()
+            m.update(header + struct.pack('>I', i + 1))
+            B += m.digest()
+    X = numpy.frombuffer(B, '<u4').astype(numpy.uint32).reshape(n, 32).T.copy()
+
+    V = numpy.empty((1024, 32, n), numpy.uint32)
+    for i in xrange(1024):
+        V[i] = X
+        _xor_salsa8_batch(X)
+
+    lanes = numpy.arange(n)
+    for i in xrange(1024):
+        k = X[16] & 1023
+        X ^= V[k, :, lanes].T
+        _xor_salsa8_batch(X)
+
+    B = X.T.astype('<u4').tostring()
+    hashes = []
+    for j, mac in enumerate(macs):
+        mac.update(B[j*128:(j+1)*128] + '\0\0\0\x01')
+        hashes.append(mac.digest())
+    return hashes
+
+
+# salsa20/8 quarter-round steps: t[a] ^= (t[b] + t[c]) <<< r
+_SALSA_STEPS = [
+    (4, 0, 12, 7), (8, 4, 0, 9), (12, 8, 4, 13), (0, 12, 8, 18),
+    (9, 5, 1, 7), (13, 9, 5, 9), (1, 13, 9, 13), (5, 1, 13, 18),
+    (14, 10, 6, 7), (2, 14, 10, 9), (6, 2, 14, 13), (10, 6, 2, 18),
+    (3, 15, 11, 7), (7, 3, 15, 9), (11, 7, 3, 13), (15, 11, 7, 18),
+    (1, 0, 3, 7), (2, 1, 0, 9), (3, 2, 1, 13), (0, 3, 2, 18),
+    (6, 5, 4, 7), (7, 6, 5, 9), (4, 7, 6, 13), (5, 4, 7, 18),
+    (11, 10, 9, 7), (8, 11, 10, 9), (9, 8, 11, 13), (10, 9, 8, 18),
+    (12, 15, 14, 7), (13, 12, 15, 9), (14, 13, 12, 13), (15, 14, 13, 18),
+]
+
+
+def _xor_salsa8_batch(X):
+    # same as _xor_salsa8_2, on a 32 x lanes uint32 array
+    for x, y in ((X[:16], X[16:]), (X[16:], X[:16])):
+        x ^= y
+        t = list(x)
+        for j in xrange(4):
+            for a, b, c, r in _SALSA_STEPS:
+                s = t[b] + t[c]
+                t[a] = t[a] ^ ((s << numpy.uint32(r)) | (s >> numpy.uint32(32 - r)))
+        x += numpy.array(t)
+
+
 def _xor_salsa8_2(X):
     [
         x00, x01, x02, x03, x04, x05, x06, x07,
@@ -260,6 +349,8 @@ if __name__ == '__main__':
 
     for header, hash in vectors:
         assert scrypt_1024_1_1_80(header.decode('hex')) == hash.decode('hex')
+    headers = [header.decode('hex') for header, hash in vectors]
+    assert scrypt_1024_1_1_80_batch(headers) == [hash.decode('hex') for header, hash in vectors]
 
     dt = (default_timer() - t0) / len(vectors)
     print "%.1f ms/hash" % (dt*1000)
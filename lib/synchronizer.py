@@ -18,7 +18,6 @@
 
 
 import threading
-import time
 import Queue
 
 import bitcoin
@@ -36,19 +35,31 @@ class WalletSynchronizer(threading.Thread):
         self.was_updated = True
         self.running = False
         self.lock = threading.Lock()
+        # responses, and None to wake the thread up
         self.queue = Queue.Queue()
         self.address_queue = Queue.Queue()
+        # the thread waits for connections, and for the network to have
+        # all its requests answered before the wallet is up to date
+        self.network.register_callback('status', self.wakeup)
+        self.network.register_callback('up_to_date', self.wakeup)
 
     def stop(self):
         with self.lock:
             self.running = False
+        self.network.unregister_callback('status', self.wakeup)
+        self.network.unregister_callback('up_to_date', self.wakeup)
+        self.wakeup()
 
     def is_running(self):
         with self.lock:
             return self.running
 
+    def wakeup(self):
+        self.queue.put(None)
+
     def add(self, address):
         self.address_queue.put(address)
+        self.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         messages = []
@@ -60,26 +71,49 @@ class WalletSynchronizer(threading.Thread):
         with self.lock:
             self.running = True
         while self.is_running():
-            while not self.network.is_connected():
-                time.sleep(0.1)
+            if not self.network.is_connected():
+                self.queue.get()
+                continue
             self.run_interface()
 
+    def get_responses(self, block):
+        """ the responses in the queue, without the wake up calls. If
+        block is set, wait until there is one or the thread is woken up. """
+        responses = []
+        if block:
+            r = self.queue.get()
+            if r is None:
+                return responses
+            responses.append(r)
+        while True:
+            try:
+                r = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if r is not None:
+                responses.append(r)
+        return responses
+
     def run_interface(self):
         #print_error("synchronizer: connected to", self.network.get_parameters())
 
-        requested_tx = []
-        missing_tx = []
-        requested_histories = {}
+        # (tx_hash, tx_height) of the transactions requested, and of the
+        # ones to request
+        self.requested_tx = set()
+        self.missing_tx = set()
+        self.requested_histories = {}
+        # addresses whose history is to be requested
+        self.history_requests = []
 
         # request any missing transactions
         for history in self.wallet.history.values():
             if history == ['*']: continue
             for tx_hash, tx_height in history:
-                if self.wallet.transactions.get(tx_hash) is None and (tx_hash, tx_height) not in missing_tx:
-                    missing_tx.append( (tx_hash, tx_height) )
+                if self.wallet.transactions.get(tx_hash) is None:
+                    self.missing_tx.add( (tx_hash, tx_height) )
 
-        if missing_tx:
-            print_error("missing tx", missing_tx)
+        if self.missing_tx:
+            print_error("missing tx", self.missing_tx)
 
         # subscriptions
         self.subscribe_to_addresses(self.wallet.addresses(True))
@@ -100,15 +134,23 @@ class WalletSynchronizer(threading.Thread):
             if new_addresses:
                 self.subscribe_to_addresses(new_addresses)
 
-            # request missing transactions
-            for tx_hash, tx_height in missing_tx:
-                if (tx_hash, tx_height) not in requested_tx:
-                    self.network.send([ ('blockchain.transaction.get',[tx_hash, tx_height]) ], self.queue.put)
-                    requested_tx.append( (tx_hash, tx_height) )
-            missing_tx = []
+            # request the histories and transactions found by the
+            # responses processed together, in batches
+            if self.history_requests:
+                self.network.send([ ('blockchain.address.get_history', [addr]) for addr in self.history_requests ], self.queue.put)
+                self.history_requests = []
+            # not -=, which iterates over requested_tx
+            missing_tx = self.missing_tx - self.requested_tx
+            if missing_tx:
+                self.network.send([ ('blockchain.transaction.get',[tx_hash, tx_height]) for tx_hash, tx_height in missing_tx ], self.queue.put)
+                self.requested_tx |= missing_tx
+            self.missing_tx = set()
+
+            # 2. get the responses
+            responses = self.get_responses(block=False)
 
             # detect if situation has changed
-            if self.network.is_up_to_date() and self.queue.empty():
+            if self.network.is_up_to_date() and not responses:
                 if not self.wallet.is_up_to_date():
                     self.wallet.set_up_to_date(True)
                     self.was_updated = True
@@ -121,77 +163,79 @@ class WalletSynchronizer(threading.Thread):
                 self.network.trigger_callback('updated')
                 self.was_updated = False
 
-            # 2. get a response
-            try:
-                r = self.queue.get(timeout=0.1)
-            except Queue.Empty:
-                continue
-
-            # 3. process response
-            method = r['method']
-            params = r['params']
-            result = r.get('result')
-            error = r.get('error')
-            if error:
-                print_error("error", r)
-                continue
+            # wait for a response, new addresses, or a change of the
+            # network status
+            if not responses:
+                responses = self.get_responses(block=True)
 
-            if method == 'blockchain.address.subscribe':
-                addr = params[0]
-                if self.wallet.get_status(self.wallet.get_history(addr)) != result:
-                    if requested_histories.get(addr) is None:
-                        self.network.send([('blockchain.address.get_history', [addr])], self.queue.put)
-                        requested_histories[addr] = result
-
-            elif method == 'blockchain.address.get_history':
-                addr = params[0]
-                print_error("receiving history", addr, result)
-                if result == ['*']:
-                    assert requested_histories.pop(addr) == '*'
-                    self.wallet.receive_history_callback(addr, result)
-                else:
-                    hist = []
-                    # check that txids are unique
-                    txids = []
-                    for item in result:
-                        tx_hash = item['tx_hash']
-                        if tx_hash not in txids:
-                            txids.append(tx_hash)
-                            hist.append( (tx_hash, item['height']) )
-
-                    if len(hist) != len(result):
-                        raise Exception("error: server sent history with non-unique txid", result)
-
-                    # check that the status corresponds to what was announced
-                    rs = requested_histories.pop(addr)
-                    if self.wallet.get_status(hist) != rs:
-                        raise Exception("error: status mismatch: %s"%addr)
-                
-                    # store received history
-                    self.wallet.receive_history_callback(addr, hist)
-
-                    # request transactions that we don't have 
-                    for tx_hash, tx_height in hist:
-                        if self.wallet.transactions.get(tx_hash) is None:
-                            if (tx_hash, tx_height) not in requested_tx and (tx_hash, tx_height) not in missing_tx:
-                                missing_tx.append( (tx_hash, tx_height) )
-
-            elif method == 'blockchain.transaction.get':
-                tx_hash = params[0]
-                tx_height = params[1]
-                assert tx_hash == bitcoin.hash_encode(bitcoin.Hash(result.decode('hex')))
-                tx = Transaction.deserialize(result)
-                self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-                self.was_updated = True
-                requested_tx.remove( (tx_hash, tx_height) )
-                print_error("received tx:", tx_hash, len(tx.raw))
+            # 3. process responses
+            for r in responses:
+                self.process_response(r)
 
-            else:
-                print_error("Error: Unknown message:" + method + ", " + repr(params) + ", " + repr(result) )
-
-            if self.was_updated and not requested_tx:
+            if self.was_updated and not self.requested_tx:
                 self.network.trigger_callback('updated')
                 # Updated gets called too many times from other places as well; if we use that signal we get the notification three times
                 self.network.trigger_callback("new_transaction") 
                 self.was_updated = False
 
+    def process_response(self, r):
+        method = r['method']
+        params = r['params']
+        result = r.get('result')
+        error = r.get('error')
+        if error:
+            print_error("error", r)
+            return
+
+        if method == 'blockchain.address.subscribe':
+            addr = params[0]
+            self.wallet.receive_status_callback(addr, result)
+            if self.wallet.get_address_status(addr) != result:
+                if self.requested_histories.get(addr) is None:
+                    self.history_requests.append(addr)
+                    self.requested_histories[addr] = result
+
+        elif method == 'blockchain.address.get_history':
+            addr = params[0]
+            print_error("receiving history", addr, result)
+            if result == ['*']:
+                assert self.requested_histories.pop(addr) == '*'
+                self.wallet.receive_history_callback(addr, result)
+            else:
+                hist = []
+                # check that txids are unique
+                txids = set()
+                for item in result:
+                    tx_hash = item['tx_hash']
+                    if tx_hash not in txids:
+                        txids.add(tx_hash)
+                        hist.append( (tx_hash, item['height']) )
+
+                if len(hist) != len(result):
+                    raise Exception("error: server sent history with non-unique txid", result)
+
+                # check that the status corresponds to what was announced
+                rs = self.requested_histories.pop(addr)
+                if self.wallet.get_status(hist) != rs:
+                    raise Exception("error: status mismatch: %s"%addr)
+
+                # store received history
+                self.wallet.receive_history_callback(addr, hist)
+
+                # request transactions that we don't have 
+                for tx_hash, tx_height in hist:
+                    if self.wallet.transactions.get(tx_hash) is None:
+                        self.missing_tx.add( (tx_hash, tx_height) )
+
+        elif method == 'blockchain.transaction.get':
+            tx_hash = params[0]
+            tx_height = params[1]
+            assert tx_hash == bitcoin.hash_encode(bitcoin.Hash(result.decode('hex')))
+            tx = Transaction.deserialize(result)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.was_updated = True
+            self.requested_tx.discard( (tx_hash, tx_height) )
+            print_error("received tx:", tx_hash, len(tx.raw))
+
+        else:
+            print_error("Error: Unknown message:" + method + ", " + repr(params) + ", " + repr(result) )
@@ -0,0 +1,668 @@
+import BaseHTTPServer
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+from StringIO import StringIO
+from lib import blockchain, checkpoints, scrypt
+from lib.blockchain import Blockchain, AlgoWindow, Header, ALGOS, pow_hash
+
+
+class FakeConfig(object):
+    """A stub config file to be used in tests"""
+    def __init__(self, path):
+        self.path = path
+        self.store = {}
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+
+def make_header(version, timestamp, bits=0x1e0fffff, prev='00'*32, nonce=0):
+    return struct.pack('<I32s32sIII', version, prev.decode('hex')[::-1], '\0'*32, timestamp, bits, nonce)
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.user_dir)
+
+        self._saved_stdout = sys.stdout
+        self._stdout_buffer = StringIO()
+        sys.stdout = self._stdout_buffer
+
+        self.blockchain = Blockchain(self.config, None)
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+        # Restore the "real" stdout
+        sys.stdout = self._saved_stdout
+
+
+class TestAlgoWindow(unittest.TestCase):
+
+    def test_first_is_tenth_previous_of_same_algo(self):
+        window = AlgoWindow(0)
+        for height in range(30):
+            algo = 514 if height % 2 else 2
+            window.push(height, algo, height, 0)
+        self.assertEqual(30, window.height)
+        self.assertEqual(11, window.first(514)[1])
+        self.assertEqual(10, window.count(514))
+
+    def test_first_is_earliest_when_short(self):
+        window = AlgoWindow(0)
+        for height in range(5):
+            window.push(height, 1026, height, 0)
+        self.assertEqual(0, window.first(1026)[1])
+        self.assertEqual(5, window.count(1026))
+        self.assertEqual(None, window.first(1538))
+        self.assertEqual(0, window.count(1538))
+
+    def test_push_requires_next_height(self):
+        window = AlgoWindow(5)
+        self.assertRaises(AssertionError, window.push, 6, 2, 0, 0)
+
+
+class TestGetTarget(BlockchainTestCase):
+
+    def make_chunk(self, versions):
+        return ''.join(make_header(v, 1000 + 150*i, 0x1d0fffff) for i, v in enumerate(versions))
+
+    def make_headers(self, data):
+        return [Header(data[i:i+80], i/80) for i in range(0, len(data), 80)]
+
+    def save(self, data):
+        open(self.blockchain.path(), 'wb').write(data)
+
+    def test_min_difficulty_until_ten_headers_of_algo(self):
+        data = self.make_chunk([2]*12)
+        self.save(data)
+        headers = self.make_headers(data)
+        self.assertEqual(0x1e0fffff, self.blockchain.get_target(9, headers=headers)[0])
+        self.assertEqual(0x1d0fffff, self.blockchain.get_target(11, headers=headers)[0])
+
+    def test_window_is_rebuilt_from_headers_file(self):
+        versions = [2, 514, 1026, 1538, 2050] * 20
+        self.save(self.make_chunk(versions))
+        window = self.blockchain.get_window(100)
+        self.assertTrue(window.is_full())
+        self.assertEqual((50, 1000 + 150*50, 0x1d0fffff), window.first(2))
+        self.assertEqual((54, 1000 + 150*54, 0x1d0fffff), window.first(2050))
+
+    def test_window_is_reused_at_same_height(self):
+        self.save(self.make_chunk([2]*20))
+        window = self.blockchain.get_window(20)
+        window.push(20, 2, 0, 0)
+        self.assertTrue(window is self.blockchain.get_window(21))
+        self.assertFalse(window is self.blockchain.get_window(15))
+
+
+class TestReadHeader(BlockchainTestCase):
+
+    def test_read_header_follows_file_growth(self):
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0))
+        self.assertEqual(0, self.blockchain.read_header(0).get('timestamp'))
+        self.assertEqual(None, self.blockchain.read_header(1))
+        self.blockchain.save_chunk(0, make_header(2, 0) + make_header(514, 1))
+        self.assertEqual(514, self.blockchain.read_header(1).get('version'))
+        self.assertEqual(None, self.blockchain.read_header(-1))
+
+    def test_save_header_invalidates_cache(self):
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0) + make_header(2, 1))
+        header = self.blockchain.read_header(1)
+        self.assertTrue(header is self.blockchain.read_header(1))
+        header = Header.from_dict(dict(header.as_dict(), timestamp=42))
+        self.blockchain.save_header(header)
+        self.assertEqual(42, self.blockchain.read_header(1).get('timestamp'))
+
+    def test_header_round_trip(self):
+        raw = make_header(1026, 1400000000, 0x1d0fffff, 'ab'*32, 12345)
+        header = self.blockchain.header_from_string(raw)
+        self.assertEqual('ab'*32, header.get('prev_block_hash'))
+        self.assertEqual(12345, header.get('nonce'))
+        self.assertEqual(raw, self.blockchain.header_to_string(header).decode('hex'))
+        self.assertEqual(raw, Header.from_dict(header.as_dict()).raw)
+
+    def test_header_dicts_are_accepted(self):
+        raw = make_header(514, 1400000000, 0x1d0fffff, 'cd'*32, 7)
+        d = Header(raw, 5).as_dict()
+        self.assertEqual(5, d['block_height'])
+        self.assertEqual(raw, self.blockchain.header_to_string(d).decode('hex'))
+        self.assertEqual(Header(raw).hash(), self.blockchain.hash_header(d))
+
+
+class TestSaveHeaders(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestSaveHeaders, self).setUp()
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0))
+        self.syncs = []
+        self._saved_fsync = os.fsync
+        os.fsync = self.syncs.append
+
+    def tearDown(self):
+        os.fsync = self._saved_fsync
+        self.blockchain.stop()
+        super(TestSaveHeaders, self).tearDown()
+
+    def test_contiguous_headers_are_written_at_once(self):
+        headers = [Header(make_header(2, t), t) for t in (1, 2, 3, 5)]
+        writes = []
+        write_headers = self.blockchain.write_headers
+        self.blockchain.write_headers = lambda h, data: writes.append((h, len(data))) or write_headers(h, data)
+        self.blockchain.save_headers(headers)
+        self.assertEqual([(1, 240), (5, 80)], writes)
+        self.assertEqual(5, self.blockchain.height())
+        self.assertEqual(3, self.blockchain.read_header(3).timestamp)
+        self.assertEqual(1, len(self.syncs))
+
+    def test_fsync_policy(self):
+        self.config.store['headers_fsync'] = 'never'
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.save_chunk(0, make_header(2, 0) + make_header(2, 1))
+        self.assertEqual([], self.syncs)
+        self.blockchain.stop()
+        self.config.store['headers_fsync'] = '3600'
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.save_header(Header(make_header(2, 2), 2))
+        self.assertEqual([], self.syncs)
+        self.blockchain.last_sync = 0
+        self.blockchain.save_header(Header(make_header(2, 3), 3))
+        self.assertEqual(1, len(self.syncs))
+        self.assertEqual(3, self.blockchain.height())
+
+    def test_invalid_fsync_policy(self):
+        self.config.store['headers_fsync'] = 'often'
+        self.assertEqual('chunk', Blockchain(self.config, None).fsync_policy)
+
+    def test_write_after_close_leaves_no_handle(self):
+        self.blockchain.close_headers_file()
+        self.blockchain.save_header(Header(make_header(2, 1), 1))
+        self.assertEqual(None, self.blockchain.headers_file)
+        self.assertEqual(1, self.blockchain.read_header(1).timestamp)
+
+
+class TestStop(BlockchainTestCase):
+
+    def test_stop_wakes_up_run(self):
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0))
+        self.blockchain.start()
+        self.blockchain.stop()
+        self.blockchain.join(5)
+        self.assertFalse(self.blockchain.is_alive())
+
+
+class TestPowHashes(BlockchainTestCase):
+
+    def make_headers(self):
+        return [Header(make_header(ALGOS[i % len(ALGOS)], i, nonce=i)) for i in range(20)]
+
+    def test_sha256d_pow_hash_is_block_hash(self):
+        raw = make_header(2, 0)
+        header = self.blockchain.header_from_string(raw)
+        self.assertEqual(header.hash(), pow_hash(raw))
+        self.assertEqual(header.hash(), header.pow_hash())
+
+    def test_batched_scrypt_fallback(self):
+        headers = [Header(make_header(514, i, nonce=i)) for i in range(3)] + [Header(make_header(2, 0))]
+        expected = [h.pow_hash() for h in headers]
+        headers = [Header(h.raw) for h in headers]
+        saved = blockchain.getPoWScryptHashes
+        blockchain.getPoWScryptHashes = scrypt.scrypt_1024_1_1_80_batch
+        try:
+            self.config.store['verification_workers'] = 1
+            self.blockchain.pow_hashes(headers)
+        finally:
+            blockchain.getPoWScryptHashes = saved
+        self.assertEqual(expected, [h._pow_hash for h in headers])
+
+    def test_scrypt_batches_are_not_too_small(self):
+        sizes = []
+        def scrypt_batch(headers):
+            sizes.append(len(headers))
+            return [''] * len(headers)
+        saved = scrypt.numpy, scrypt._scrypt_batch
+        scrypt.numpy, scrypt._scrypt_batch = True, scrypt_batch
+        try:
+            self.assertEqual(2*scrypt.BATCH_LANES + 1, len(scrypt.scrypt_1024_1_1_80_batch([''] * (2*scrypt.BATCH_LANES + 1))))
+            self.assertEqual(scrypt.BATCH_MIN_LANES, len(scrypt.scrypt_1024_1_1_80_batch([''] * scrypt.BATCH_MIN_LANES)))
+        finally:
+            scrypt.numpy, scrypt._scrypt_batch = saved
+        self.assertEqual([171, 171, 171, scrypt.BATCH_MIN_LANES], sizes)
+
+    def test_unknown_version(self):
+        self.assertEqual(None, pow_hash(make_header(3, 0)))
+
+    def test_worker_pool_matches_sequential(self):
+        headers = self.make_headers()
+        self.config.store['verification_workers'] = 1
+        self.blockchain.pow_hashes(headers)
+        expected = [h.pow_hash() for h in headers]
+        self.assertEqual(None, self.blockchain.pool)
+        headers = self.make_headers()
+        self.config.store['verification_workers'] = 2
+        saved = blockchain.POOL_MIN_HEADERS
+        blockchain.POOL_MIN_HEADERS = len(headers)
+        try:
+            self.blockchain.pow_hashes(self.make_headers()[:-1])
+            self.assertEqual(None, self.blockchain.pool)
+            self.blockchain.pow_hashes(headers)
+            self.assertEqual(expected, [h._pow_hash for h in headers])
+            self.assertNotEqual(None, self.blockchain.pool)
+        finally:
+            blockchain.POOL_MIN_HEADERS = saved
+            self.blockchain.stop()
+        self.assertEqual(None, self.blockchain.pool)
+
+    def test_pool_is_off_by_default(self):
+        saved = blockchain.POOL_MIN_HEADERS
+        blockchain.POOL_MIN_HEADERS = 2
+        try:
+            self.blockchain.pow_hashes(self.make_headers())
+        finally:
+            blockchain.POOL_MIN_HEADERS = saved
+        self.assertEqual(None, self.blockchain.pool)
+
+
+class TestCheckpoints(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestCheckpoints, self).setUp()
+        self._saved_hashes = checkpoints.CHUNK_HASHES
+        # a linked chunk whose proof of work does not meet its target
+        prev = '00'*32
+        self.headers = []
+        for i in range(2016):
+            raw = make_header(ALGOS[i % len(ALGOS)], 1000 + 60*i, 0x1b0fffff, prev)
+            prev = self.blockchain.hash_header(self.blockchain.header_from_string(raw))
+            self.headers.append(raw)
+        self.data = ''.join(self.headers).encode('hex')
+        checkpoints.CHUNK_HASHES = [prev]
+        open(self.blockchain.path(), 'wb').close()
+
+    def tearDown(self):
+        checkpoints.CHUNK_HASHES = self._saved_hashes
+        super(TestCheckpoints, self).tearDown()
+
+    def test_checkpointed_chunk_skips_proof_of_work(self):
+        self.blockchain.verify_chunk(0, self.data)
+        self.assertEqual(2015, self.blockchain.height())
+        self.assertEqual(2016, self.blockchain.window.height)
+        self.assertEqual((2015, 1000 + 60*2015, 0x1b0fffff), self.blockchain.window.get(ALGOS[0])[-1])
+
+    def test_checkpoint_mismatch(self):
+        checkpoints.CHUNK_HASHES = ['11'*32]
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, self.data)
+        self.assertEqual(None, self.blockchain.read_header(0))
+        self.assertEqual(None, self.blockchain.window)
+
+    def test_full_verification(self):
+        self.config.store['full_verification'] = True
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, self.data)
+
+    def test_full_verification_from_system_config(self):
+        self.config.store['full_verification'] = 'True'
+        self.assertEqual(None, self.blockchain.get_checkpoint(0))
+        self.config.store['full_verification'] = 'False'
+        self.assertEqual(checkpoints.CHUNK_HASHES[0], self.blockchain.get_checkpoint(0))
+
+
+class HeadersHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ serves server.data with range requests; closes the connection
+    after server.cut bytes if it is set """
+
+    def do_GET(self):
+        data = self.server.data
+        self.server.ranges.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('Range') and not self.server.ignore_range:
+            start = int(self.headers['Range'][6:-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if self.server.cut is not None:
+            body = body[:self.server.cut]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBootstrap(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestBootstrap, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HeadersHandler)
+        self.server.data = ''.join(make_header(2, i) for i in range(2016*2 + 100))
+        self.server.ranges = []
+        self.server.cut = None
+        self.server.ignore_range = False
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.blockchain.headers_url = 'http://127.0.0.1:%d/blockchain_headers' % self.server.server_port
+        self.verified = []
+        self.reject = None
+        self.blockchain.verify_chunk = self.verify_chunk
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.blockchain.stop()
+        super(TestBootstrap, self).tearDown()
+
+    def verify_chunk(self, index, hexdata):
+        if index == self.reject:
+            raise Exception('bad chunk')
+        self.verified.append(index)
+        self.blockchain.save_chunk(index, hexdata.decode('hex'))
+
+    def headers(self):
+        return open(self.blockchain.path(), 'rb').read()
+
+    def test_download(self):
+        self.blockchain.init_headers_file()
+        self.assertEqual([0, 1, 2], self.verified)
+        self.assertEqual(self.server.data, self.headers())
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+        self.assertEqual(2016*2 + 99, self.blockchain.height())
+
+    def test_interrupted_download_is_resumed(self):
+        self.server.cut = 2016*80 + 5000
+        self.blockchain.init_headers_file()
+        self.assertEqual([0], self.verified)
+        self.assertEqual(2016*80, len(self.headers()))
+        self.assertTrue(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+        self.server.cut = None
+        self.blockchain.init_headers_file()
+        self.assertEqual([None, 'bytes=%d-' % (2016*80)], self.server.ranges)
+        self.assertEqual([0, 1, 2], self.verified)
+        self.assertEqual(self.server.data, self.headers())
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+    def test_ignored_range_is_skipped(self):
+        self.server.cut = 2016*80 + 5000
+        self.blockchain.init_headers_file()
+        self.server.cut = None
+        self.server.ignore_range = True
+        self.blockchain.init_headers_file()
+        self.assertEqual([0, 1, 2], self.verified)
+        self.assertEqual(self.server.data, self.headers())
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+    def test_download_without_data_is_not_resumed(self):
+        self.server.cut = 5000
+        self.blockchain.init_headers_file()
+        self.assertEqual([], self.verified)
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+    def test_headers_synced_since_are_kept(self):
+        self.server.cut = 2016*80 + 5000
+        self.blockchain.init_headers_file()
+        self.assertEqual('%d' % (2016*80), open(self.blockchain.path() + '.bootstrap').read())
+        # the servers sent more headers before the next start
+        extra = ''.join(make_header(2, i) for i in range(2016, 2016 + 10))
+        open(self.blockchain.path(), 'ab').write(extra)
+        self.blockchain.init_headers_file()
+        self.assertEqual([None], self.server.ranges)
+        self.assertEqual(2016*80 + len(extra), len(self.headers()))
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+    def test_rejected_chunk_ends_bootstrap(self):
+        self.reject = 1
+        self.blockchain.init_headers_file()
+        self.assertEqual([0], self.verified)
+        self.assertEqual(2016*80, len(self.headers()))
+        self.assertFalse(os.path.exists(self.blockchain.path() + '.bootstrap'))
+
+    def test_existing_file_is_kept(self):
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0))
+        self.blockchain.init_headers_file()
+        self.assertEqual([], self.server.ranges)
+
+    def test_old_header_store_is_removed(self):
+        open(self.blockchain.path(), 'wb').write(make_header(2, 0))
+        db_path = os.path.join(self.user_dir, 'headers.db')
+        open(db_path, 'wb').close()
+        self.blockchain.init_headers_file()
+        self.assertFalse(os.path.exists(db_path))
+
+
+class FakeInterface(object):
+
+    is_connected = True
+
+    def __init__(self, answers=None, server='fake:50001:t'):
+        self.server = server
+        self.requests = []
+        self.answers = answers if answers is not None else {}
+
+    def send_request(self, request, queue):
+        index = request['params'][0]
+        self.requests.append(index)
+        result = self.answers.get(index, 'chunk%d' % index)
+        queue.put((self, {'method':request['method'], 'params':[index], 'result':result}))
+
+
+class FakeNetwork(object):
+
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+
+    def get_chunk_interfaces(self, height):
+        return self.interfaces
+
+
+class HeaderServer(object):
+    """ answers header and chunk requests from a list of raw headers """
+
+    is_connected = True
+    server = 'headers:50001:t'
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.requests = []
+        self.batches = 0
+
+    def send_requests(self, requests, queue):
+        self.batches += 1
+        for request in requests:
+            self.send_request(request, queue)
+
+    def send_request(self, request, queue):
+        method = request['method']
+        index = request['params'][0]
+        self.requests.append((method, index))
+        if method == 'blockchain.block.get_header':
+            result = Header(self.headers[index], index).as_dict()
+        else:
+            result = ''.join(self.headers[index*2016:(index+1)*2016]).encode('hex')
+        queue.put((self, {'method':method, 'params':[index], 'result':result}))
+
+
+class ChainTestCase(BlockchainTestCase):
+    """ a local chain of 300 headers """
+
+    def make_chain(self, n, prev='00'*32, start=0, nonce=0):
+        headers = []
+        for i in range(start, start + n):
+            raw = make_header(2, i, prev=prev, nonce=nonce)
+            prev = Header(raw).hash()
+            headers.append(raw)
+        return headers
+
+    def setUp(self):
+        super(ChainTestCase, self).setUp()
+        self.local = self.make_chain(300)
+        open(self.blockchain.path(), 'wb').write(''.join(self.local))
+        self.blockchain.set_local_height()
+
+    def get_chain(self, remote):
+        server = HeaderServer(remote)
+        self.rounds = 0
+        for name in ['get_headers', 'get_chunks']:
+            f = getattr(self.blockchain, name)
+            setattr(self.blockchain, name, lambda i, params, queue, f=f: self.count_round(f, i, params, queue))
+        tip = len(remote) - 1
+        chain = self.blockchain.get_chain(server, Header(remote[tip], tip))
+        return server, chain
+
+    def count_round(self, f, *args):
+        self.rounds += 1
+        return f(*args)
+
+    def fork(self, height, length):
+        prev = Header(self.local[height]).hash()
+        return self.local[:height + 1] + self.make_chain(length, prev, height + 1, nonce=1)
+
+
+class TestGetChain(ChainTestCase):
+
+    def test_tip_extends_chain(self):
+        server, chain = self.get_chain(self.local + self.make_chain(1, Header(self.local[-1]).hash(), 300))
+        self.assertEqual([300], [h.block_height for h in chain])
+        self.assertEqual([], server.requests)
+
+    def test_gap_is_fetched_at_once(self):
+        remote = self.local + self.make_chain(20, Header(self.local[-1]).hash(), 300)
+        server, chain = self.get_chain(remote)
+        self.assertEqual(range(300, 320), [h.block_height for h in chain])
+        self.assertEqual(19, len(server.requests))
+
+    def test_reorg_fork_point_is_found_by_bisection(self):
+        remote = self.fork(123, 200)
+        server, chain = self.get_chain(remote)
+        self.assertEqual(range(124, 324), [h.block_height for h in chain])
+        self.assertEqual([r[:80] for r in remote[124:]], [h.raw for h in chain])
+        # the headers after the fork point are requested as chunks
+        self.assertTrue(('blockchain.block.get_chunk', 0) in server.requests)
+        self.assertTrue(self.rounds <= 6)
+        # the probes of each round are sent as one batch
+        self.assertEqual(self.rounds, server.batches)
+
+    def test_short_reorg(self):
+        remote = self.fork(297, 5)
+        server, chain = self.get_chain(remote)
+        self.assertEqual(range(298, 303), [h.block_height for h in chain])
+        self.assertEqual(2, self.rounds)
+
+
+class TestTips(ChainTestCase):
+
+    def setUp(self):
+        super(TestTips, self).setUp()
+        self.heights = []
+        self.blockchain.network = self
+        self.blockchain.verify_chain = lambda chain: True
+
+    def new_blockchain_height(self, height, i):
+        self.heights.append((height, i.server))
+
+    def make_servers(self, remote, names):
+        servers = []
+        for name in names:
+            server = HeaderServer(remote)
+            server.server = name
+            servers.append(server)
+        return servers
+
+    def test_same_tip_is_processed_once(self):
+        remote = self.local + self.make_chain(2, Header(self.local[-1]).hash(), 300)
+        a, b, c = self.make_servers(remote, ['a', 'b', 'c'])
+        old = Header(remote[300], 300)
+        tip = Header(remote[301], 301)
+        tips = self.blockchain.group_tips([(a, tip), (b, old), (c, tip), None])
+        self.assertEqual([(tip, [a, c]), (old, [b])], tips)
+        self.assertEqual(['a', 'c'], sorted(self.blockchain.get_tip_servers(tip.hash())))
+        for header, interfaces in tips:
+            self.blockchain.process_tip(header, interfaces)
+        self.assertEqual(301, self.blockchain.height())
+        self.assertEqual([(301, 'a')], self.heights)
+        self.assertEqual(1, len(a.requests))
+        self.assertEqual([], b.requests + c.requests)
+
+    def test_next_server_is_tried_on_failure(self):
+        remote = self.local + self.make_chain(1, Header(self.local[-1]).hash(), 300)
+        a, b = self.make_servers(remote, ['a', 'b'])
+        a.is_connected = False
+        self.blockchain.process_tip(Header(remote[300], 300), [a, b])
+        self.assertEqual([(300, 'b')], self.heights)
+
+
+class TestGetAndVerifyChunks(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestGetAndVerifyChunks, self).setUp()
+        self.blockchain.running = True
+        self.verified = []
+        self.failures = {}
+        self.unlinked = {}
+        self.blockchain.verify_chunk = self.verify_chunk
+
+    def verify_chunk(self, index, data):
+        assert data.startswith('chunk%d' % index)
+        if self.unlinked.get(index):
+            self.unlinked[index] -= 1
+            raise blockchain.ChunkLinkError(index)
+        if self.failures.get(index) or data.endswith('bad'):
+            self.failures[index] = self.failures.get(index, 1) - 1
+            raise Exception('bad chunk')
+        self.verified.append((index, len(self.interface.requests)))
+
+    def test_chunks_are_prefetched_and_verified_in_order(self):
+        self.interface = FakeInterface()
+        self.assertTrue(self.blockchain.get_and_verify_chunks(self.interface, None, 5*2016))
+        self.assertEqual([0, 1, 2, 3, 4, 5], [index for index, _ in self.verified])
+        # four requests were outstanding when the first chunk was verified
+        self.assertEqual(4, self.verified[0][1])
+
+    def test_failed_chunk_is_requested_again(self):
+        self.interface = FakeInterface()
+        self.failures[1] = 2
+        self.assertTrue(self.blockchain.get_and_verify_chunks(self.interface, None, 3*2016))
+        self.assertEqual([0, 1, 2, 3], [index for index, _ in self.verified])
+        self.assertEqual(3, self.interface.requests.count(1))
+
+    def test_unlinked_chunk_steps_back(self):
+        self.interface = FakeInterface()
+        self.unlinked[2] = 1
+        self.assertTrue(self.blockchain.get_and_verify_chunks(self.interface, None, 3*2016))
+        self.assertEqual([0, 1, 1, 2, 3], [index for index, _ in self.verified])
+        self.assertEqual(2, self.interface.requests.count(1))
+        self.assertEqual(2, self.interface.requests.count(2))
+
+    def test_gives_up_after_retries(self):
+        self.interface = FakeInterface({2: None})
+        self.assertFalse(self.blockchain.get_and_verify_chunks(self.interface, None, 3*2016))
+        self.assertEqual([0, 1], [index for index, _ in self.verified])
+
+    def test_chunks_are_spread_over_servers(self):
+        self.interface = FakeInterface()
+        other = FakeInterface(server='other:50001:t')
+        self.blockchain.network = FakeNetwork([self.interface, other])
+        self.assertTrue(self.blockchain.get_and_verify_chunks(self.interface, None, 7*2016))
+        self.assertEqual(range(8), [index for index, _ in self.verified])
+        self.assertEqual(4, len(self.interface.requests))
+        self.assertEqual(4, len(other.requests))
+        self.assertEqual(4, self.blockchain.chunk_stats['other:50001:t'][0])
+
+    def test_invalid_chunk_is_requested_from_another_server(self):
+        self.interface = FakeInterface()
+        bad = FakeInterface({1: 'chunk1bad'}, server='bad:50001:t')
+        self.blockchain.network = FakeNetwork([self.interface, bad])
+        self.assertTrue(self.blockchain.get_and_verify_chunks(self.interface, None, 3*2016))
+        self.assertEqual(range(4), [index for index, _ in self.verified])
+        self.assertEqual(1, bad.requests.count(1))
+        self.assertEqual(1, self.interface.requests.count(1))
@@ -0,0 +1,48 @@
+import Queue
+import socket
+import unittest
+
+from lib.interface import TcpInterface
+from lib.util import SocketPipe
+
+
+class FakeConfig(object):
+
+    def __init__(self, options):
+        self.options = options
+
+    def get(self, key, default=None):
+        return self.options.get(key, default)
+
+
+class TestBatchRequests(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBatchRequests, self).setUp()
+        # values read from the system config file are strings
+        self.interface = TcpInterface('localhost:50001:t', FakeConfig({'server_batch_size':'2'}))
+        self.interface.response_queue = Queue.Queue()
+        a, b = socket.socketpair()
+        self.interface.pipe = SocketPipe(a)
+        self.server = SocketPipe(b)
+
+    def test_responses_go_to_their_request(self):
+        queue = Queue.Queue()
+        requests = [{'id':10+i, 'method':'blockchain.address.get_history', 'params':['addr%d'%i]} for i in range(3)]
+        self.interface.send_requests(requests, queue)
+        batch = self.server.get()
+        self.assertEqual(2, len(batch))
+        single = self.server.get()
+        self.assertEqual(['addr2'], single['params'])
+        # the server may answer in any order
+        for r in reversed(batch + [single]):
+            self.interface.process_response({'id':r['id'], 'result':r['params'][0]})
+        answers = [queue.get_nowait()[1] for i in range(3)]
+        self.assertEqual(['addr2', 'addr1', 'addr0'], [r['result'] for r in answers])
+        self.assertEqual([12, 11, 10], [r['id'] for r in answers])
+        self.assertEqual(['addr2'], answers[0]['params'])
+        self.assertEqual({}, self.interface.unanswered_requests)
+
+    def test_servers_get_no_batches_by_default(self):
+        interface = TcpInterface('localhost:50001:t', FakeConfig({'batch_size':'100'}))
+        self.assertEqual(1, interface.batch_size)
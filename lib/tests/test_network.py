@@ -0,0 +1,72 @@
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from StringIO import StringIO
+from lib.network import Network
+from lib.version import PROTOCOL_VERSION
+
+
+class FakeConfig(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.store = {'server': 'main:50002:s', 'protocol': 's'}
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+
+class FakeInterface(object):
+
+    is_connected = True
+
+    def __init__(self, server):
+        self.server = server
+
+    def stop(self):
+        pass
+
+
+class TestMaintainInterfaces(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMaintainInterfaces, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self._saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.network = Network(FakeConfig(self.user_dir))
+        self.network.interface = FakeInterface('main:50002:s')
+        self.network.interfaces = {'main:50002:s': self.network.interface}
+        # no other server is known yet
+        self.network.irc_servers = {'main': {'s': '50002'}}
+        self.network.response_queue = Queue.Queue()
+        self.started = []
+        self.network.start_interface = self.start_interface
+
+    def tearDown(self):
+        super(TestMaintainInterfaces, self).tearDown()
+        sys.stdout = self._saved_stdout
+        shutil.rmtree(self.user_dir)
+
+    def start_interface(self, server):
+        self.started.append(server)
+        self.network.pending_servers.add(server)
+
+    def test_recheck_is_scheduled_while_short_of_servers(self):
+        self.assertNotEqual(None, self.network.maintain_interfaces())
+        self.assertEqual([], self.started)
+
+    def test_peers_are_connected_when_received(self):
+        self.network.maintain_interfaces()
+        self.network.running = True
+        threading.Thread.start(self.network)
+        peers = [['', 'peer%d' % n, ['s', 'v' + PROTOCOL_VERSION]] for n in range(3)]
+        self.network.queue.put((self.network.interface, {'method': 'server.peers.subscribe', 'params': [], 'result': peers}))
+        self.network.response_queue.get(timeout=5)
+        self.network.stop()
+        self.network.join(5)
+        self.assertEqual(['peer0:50009:s', 'peer1:50009:s', 'peer2:50009:s'], sorted(self.started))
@@ -0,0 +1,58 @@
+import Queue
+import socket
+import time
+import unittest
+
+from lib.network_proxy import NetworkProxy
+from lib.util import SocketPipe
+
+
+class FakeConfig(object):
+
+    def get(self, key, default=None):
+        return default
+
+
+class TestNetworkProxy(unittest.TestCase):
+
+    def setUp(self):
+        super(TestNetworkProxy, self).setUp()
+        a, b = socket.socketpair()
+        self.daemon = SocketPipe(b)
+        self.daemon.set_timeout(5)
+        self.proxy = NetworkProxy(a, FakeConfig())
+        self.proxy.start()
+
+    def tearDown(self):
+        super(TestNetworkProxy, self).tearDown()
+        self.proxy.stop()
+        self.proxy.join(5)
+
+    def test_batch_responses_reach_callbacks(self):
+        queue = Queue.Queue()
+        events = Queue.Queue()
+        self.proxy.register_callback('up_to_date', lambda: events.put('up_to_date'))
+        self.proxy.send([('blockchain.address.get_history', ['addr%d'%i]) for i in range(3)], queue.put)
+        batch = self.daemon.get()
+        self.assertEqual(3, len(batch))
+        self.daemon.send([{'id':r['id'], 'result':r['params'][0]} for r in batch])
+        results = [queue.get(timeout=5)['result'] for i in range(3)]
+        self.assertEqual(['addr0', 'addr1', 'addr2'], results)
+        self.assertEqual('up_to_date', events.get(timeout=5))
+        self.assertTrue(self.proxy.is_up_to_date())
+
+    def test_unregistered_callback_is_not_called(self):
+        events = []
+        callback = lambda: events.append('status')
+        self.proxy.register_callback('status', callback)
+        self.proxy.trigger_callback('status')
+        self.proxy.unregister_callback('status', callback)
+        self.proxy.trigger_callback('status')
+        self.assertEqual(['status'], events)
+
+    def test_stop_wakes_the_thread_up(self):
+        t0 = time.time()
+        self.proxy.stop()
+        self.proxy.join(5)
+        self.assertFalse(self.proxy.is_alive())
+        self.assertTrue(time.time() - t0 < 1)
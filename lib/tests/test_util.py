@@ -1,5 +1,6 @@
+import socket
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, LRUCache, SocketPipe, QueuePipe
 
 class TestUtil(unittest.TestCase):
 
@@ -63,3 +64,45 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'myriadcoin:MRBurdDdLMqWLCy4Fp1wMDiKT1MK7DJFkS?amount=0.0003&label=test&amount=30.0')
 
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual('a', cache.get(1))
+        cache.put(3, 'c')
+        self.assertEqual(None, cache.get(2))
+        self.assertEqual('a', cache.get(1))
+        self.assertEqual('c', cache.get(3))
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        self.assertEqual('a', cache.pop(1))
+        self.assertEqual(None, cache.get(1))
+
+
+class TestPipes(unittest.TestCase):
+
+    requests = [{'id':i, 'method':'server.version', 'params':[]} for i in range(3)]
+
+    def test_socket_pipe_sends_batches(self):
+        a, b = socket.socketpair()
+        SocketPipe(a).send_all(self.requests, 2)
+        pipe = SocketPipe(b)
+        self.assertEqual(self.requests[:2], pipe.get())
+        self.assertEqual(self.requests[2], pipe.get())
+
+    def test_socket_pipe_without_batches(self):
+        a, b = socket.socketpair()
+        SocketPipe(a).send_all(self.requests)
+        pipe = SocketPipe(b)
+        self.assertEqual(self.requests, [pipe.get() for i in range(3)])
+
+    def test_queue_pipe_sends_batches(self):
+        pipe = QueuePipe()
+        pipe.send_all(self.requests, 2)
+        self.assertEqual(self.requests[:2], pipe.send_queue.get_nowait())
+        self.assertEqual(self.requests[2], pipe.send_queue.get_nowait())
@@ -0,0 +1,282 @@
+import unittest
+
+from lib import verifier
+from lib.bitcoin import Hash, hash_encode, hash_decode
+from lib.verifier import TxVerifier
+
+
+def merkle_tree(tx_hashes):
+    """ return the merkle root and the branch of each transaction """
+    level = [hash_decode(h) for h in tx_hashes]
+    branches = [[] for h in tx_hashes]
+    positions = range(len(tx_hashes))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for n, pos in enumerate(positions):
+            branches[n].append(hash_encode(level[pos ^ 1]))
+            positions[n] = pos >> 1
+        level = [Hash(level[i] + level[i+1]) for i in range(0, len(level), 2)]
+    return hash_encode(level[0]), branches
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.store = {}
+        self.writes = 0
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+    def put(self, key, value, save=True):
+        self.store[key] = value
+        if save:
+            self.writes += 1
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.height = 0
+        self.sent = []
+        self.callbacks = {}
+        self.accept = True
+        self.headers = {}
+        self.header_reads = 0
+
+    def register_callback(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def unregister_callback(self, event, callback):
+        self.callbacks[event].remove(callback)
+
+    def trigger_callback(self, event):
+        for callback in self.callbacks.get(event, []):
+            callback()
+
+    def get_local_height(self):
+        return self.height
+
+    def get_header(self, height):
+        self.header_reads += 1
+        return self.headers.get(height)
+
+    def send(self, messages, callback):
+        if not self.accept:
+            return
+        self.sent += [params[0] for method, params in messages]
+        return [len(self.sent)]
+
+
+class TestTxVerifier(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxVerifier, self).setUp()
+        self.network = FakeNetwork()
+        self.verifier = TxVerifier(self.network, FakeStorage())
+
+    def test_stop_unregisters_callback(self):
+        self.assertEqual([self.verifier.wakeup], self.network.callbacks['updated'])
+        self.verifier.stop()
+        self.assertEqual([], self.network.callbacks['updated'])
+
+    def test_merkle_is_requested_when_header_is_available(self):
+        self.verifier.add('a', 10)
+        self.verifier.add('b', 20)
+        self.network.height = 15
+        self.verifier.request_merkles()
+        self.assertEqual(['a'], self.network.sent)
+        self.network.height = 25
+        self.verifier.request_merkles()
+        self.verifier.request_merkles()
+        self.assertEqual(['a', 'b'], self.network.sent)
+        self.assertEqual({}, self.verifier.pending)
+
+    def test_verified_tx_is_not_requested(self):
+        self.verifier.verified_tx['a'] = (10, 0, 0)
+        self.verifier.add('a', 10)
+        self.network.height = 10
+        self.verifier.request_merkles()
+        self.assertEqual([], self.network.sent)
+
+    def test_failed_request_is_retried(self):
+        self.network.accept = False
+        self.network.height = 10
+        self.verifier.add('a', 10)
+        self.verifier.request_merkles()
+        self.network.accept = True
+        self.verifier.request_merkles()
+        self.assertEqual(['a'], self.network.sent)
+
+    def test_updated_wakes_up_the_thread(self):
+        while not self.verifier.queue.empty():
+            self.verifier.queue.get()
+        self.network.trigger_callback('updated')
+        self.assertEqual(None, self.verifier.queue.get_nowait())
+
+    def test_batch_is_sent_at_once(self):
+        for i in range(5):
+            self.verifier.add('tx%d' % i, 10)
+        self.network.height = 10
+        self.verifier.request_merkles()
+        self.assertEqual(5, len(self.network.sent))
+        self.assertEqual(5, len(self.verifier.requested_merkle))
+
+
+class TestMerkleVerification(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMerkleVerification, self).setUp()
+        self.network = FakeNetwork()
+        self.verifier = TxVerifier(self.network, FakeStorage())
+        self.tx_hashes = [hash_encode(Hash(str(i))) for i in range(7)]
+        root, self.branches = merkle_tree(self.tx_hashes)
+        self.network.headers[10] = {'merkle_root': root, 'timestamp': 1234}
+
+    def response(self, n, branch=None):
+        result = {'block_height': 10, 'pos': n, 'merkle': branch or self.branches[n]}
+        return {'method': 'blockchain.transaction.get_merkle', 'params': [self.tx_hashes[n], 10], 'result': result}
+
+    def test_block_header_is_read_once(self):
+        self.verifier.process_responses([self.response(n) for n in range(7)])
+        self.assertEqual(1, self.network.header_reads)
+        for n in range(7):
+            self.assertEqual((10, 1234, n), self.verifier.verified_tx[self.tx_hashes[n]])
+
+    def test_branches_share_proven_nodes(self):
+        hashes = []
+        saved = verifier.Hash
+        verifier.Hash = lambda x: hashes.append(x) or saved(x)
+        try:
+            self.verifier.process_responses([self.response(n) for n in range(7)])
+        finally:
+            verifier.Hash = saved
+        # 3 for the first branch, then 1 for tx 2 and 6 and 2 for tx 4,
+        # which stop at a proven node; 1, 3 and 5 are proven leaves
+        self.assertEqual(7, len(hashes))
+        self.assertEqual(7, len(self.verifier.verified_tx))
+
+    def test_invalid_branch(self):
+        bad = list(self.branches[3])
+        bad[1] = '00'*32
+        self.verifier.process_responses([self.response(3, bad)])
+        self.assertEqual({}, self.verifier.verified_tx)
+
+    def test_invalid_branch_after_valid_one(self):
+        bad = list(self.branches[3])
+        bad[0] = '00'*32
+        self.verifier.process_responses([self.response(0), self.response(3, bad)])
+        self.assertTrue(self.tx_hashes[0] in self.verifier.verified_tx)
+        self.assertFalse(self.tx_hashes[3] in self.verifier.verified_tx)
+
+    def test_invalid_branch_to_proven_node(self):
+        bad = list(self.branches[1])
+        bad[0] = '00'*32
+        responses = [self.response(0), self.response(1, bad)]
+        responses[1]['params'][0] = '11'*32
+        self.verifier.process_responses(responses)
+        self.assertEqual([self.tx_hashes[0]], self.verifier.verified_tx.keys())
+
+    def test_results_are_saved_once_per_interval(self):
+        storage = self.verifier.storage
+        self.verifier.process_responses([self.response(n) for n in range(3)])
+        self.assertEqual(1, storage.writes)
+        self.assertEqual(3, len(storage.store['verified_tx3']))
+        self.assertEqual(3, len(storage.store['merkle_roots']))
+        self.verifier.process_responses([self.response(n) for n in range(3, 7)])
+        self.assertEqual(1, storage.writes)
+        self.assertTrue(self.verifier.save_timeout() > 0)
+        self.verifier.stop()
+        self.assertEqual(2, storage.writes)
+        self.assertEqual(7, len(storage.store['verified_tx3']))
+        self.assertEqual(None, self.verifier.save_timeout())
+
+
+    def test_counters(self):
+        for n in range(3):
+            self.verifier.add(self.tx_hashes[n], 10)
+        self.verifier.add('ff'*32, 50)
+        self.network.height = 10
+        self.verifier.request_merkles()
+        status = self.verifier.get_status()
+        self.assertEqual(3, status['requested'])
+        self.assertEqual(3, status['in_flight'])
+        self.assertEqual(1, status['waiting_for_headers'])
+        bad = list(self.branches[2])
+        bad[0] = '00'*32
+        self.verifier.process_responses([self.response(0), self.response(1), self.response(2, bad)])
+        status = self.verifier.get_status()
+        self.assertEqual(2, status['verified'])
+        self.assertEqual(1, status['failed'])
+        self.assertEqual(0, status['in_flight'])
+        self.assertEqual(2, status['unverified'])
+        self.assertEqual(2, status['latency']['count'])
+        self.assertEqual(('+Inf', 2), status['latency']['buckets'][-1])
+
+
+class TestUndoVerifications(unittest.TestCase):
+
+    def setUp(self):
+        super(TestUndoVerifications, self).setUp()
+        self.network = FakeNetwork()
+        storage = FakeStorage()
+        storage.store['verified_tx3'] = {'a': [10, 0, 0], 'b': [20, 0, 0], 'c': [20, 0, 1], 'd': [30, 0, 0]}
+        storage.store['merkle_roots'] = {'a': 'r10', 'b': 'r20', 'c': 'r20', 'd': 'r30'}
+        self.verifier = TxVerifier(self.network, storage)
+        for tx_hash, (height, timestamp, pos) in storage.store['verified_tx3'].items():
+            self.verifier.add(tx_hash, height)
+
+    def test_index_is_loaded_from_storage(self):
+        self.assertEqual([10, 20, 30], self.verifier.verified_heights)
+        self.assertEqual(set(['b', 'c']), self.verifier.verified_by_height[20])
+
+    def test_undo_only_affects_blocks_above_height(self):
+        self.verifier.undo_verifications(15)
+        self.assertEqual(['a'], self.verifier.verified_tx.keys())
+        self.assertEqual(['a'], self.verifier.merkle_roots.keys())
+        self.assertEqual([10], self.verifier.verified_heights)
+        self.assertEqual(-1, self.verifier.get_confirmations('b')[0])
+        # the rolled back transactions are verified again
+        self.network.height = 30
+        self.verifier.request_merkles()
+        self.assertEqual(['b', 'c', 'd'], sorted(self.network.sent))
+
+
+class TestTxInfo(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxInfo, self).setUp()
+        self.network = FakeNetwork()
+        self.network.height = 20
+        self.verifier = TxVerifier(self.network, FakeStorage())
+        self.verifier.add('a', 10)
+        self.computed = []
+        compute = self.verifier.compute_tx_info
+        self.verifier.compute_tx_info = lambda *args: self.computed.append(args[0]) or compute(*args)
+
+    def test_info_is_cached_until_new_height(self):
+        self.assertEqual(((10, 0), -1, None), self.verifier.get_tx_info('a'))
+        self.assertEqual((10, 0), self.verifier.get_txpos('a'))
+        self.assertEqual((-1, None), self.verifier.get_confirmations('a'))
+        self.assertEqual(['a'], self.computed)
+        self.network.height = 21
+        self.verifier.get_confirmations('a')
+        self.assertEqual(['a', 'a'], self.computed)
+
+    def test_verification_invalidates_info(self):
+        self.verifier.get_tx_info('a')
+        with self.verifier.lock:
+            self.verifier.verified_tx['a'] = (10, 1234, 3)
+            self.verifier.index_verified('a', 10)
+            self.verifier.invalidate('a')
+        self.assertEqual(((10, 3), 11, 1234), self.verifier.get_tx_info('a'))
+        self.verifier.undo_verifications(10)
+        self.assertEqual(((10, 0), -1, None), self.verifier.get_tx_info('a'))
+
+    def test_moved_transactions(self):
+        self.assertEqual(set(['a']), self.verifier.pop_moved())
+        self.assertEqual(set(), self.verifier.pop_moved())
+        self.verifier.add('b', 12)
+        self.verifier.add('a', 10)
+        self.assertEqual(set(['b']), self.verifier.pop_moved())
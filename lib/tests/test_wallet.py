@@ -162,3 +162,115 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+
+class TestSortedHistory(WalletTestCase):
+
+    def setUp(self):
+        super(TestSortedHistory, self).setUp()
+        from lib.verifier import TxVerifier
+        from lib.tests.test_verifier import FakeNetwork, FakeStorage
+        self.wallet = NewWallet(WalletStorage(self.fake_config))
+        self.wallet.transactions = {}
+        self.network = FakeNetwork()
+        self.network.height = 100
+        self.verifier = TxVerifier(self.network, FakeStorage())
+        self.wallet.set_verifier(self.verifier)
+
+    def add(self, tx_hash, height=None):
+        self.wallet.transactions[tx_hash] = None
+        if height:
+            self.verifier.add(tx_hash, height)
+
+    def test_history_is_sorted_by_txpos(self):
+        for i, height in enumerate([30, 10, 20, 0, 40]):
+            self.add('tx%d' % i, height)
+        self.assertEqual(['tx1', 'tx2', 'tx0', 'tx4', 'tx3'], self.wallet.get_sorted_history())
+
+    def test_only_moved_transactions_are_resorted(self):
+        for i in range(20):
+            self.add('tx%02d' % i, 10 + i)
+        self.wallet.get_sorted_history()
+        self.add('new')
+        del self.wallet.transactions['tx05']
+        with self.verifier.lock:
+            self.verifier.verified_tx['tx00'] = (50, 0, 0)
+            self.verifier.invalidate('tx00')
+        calls = []
+        get_txpos = self.verifier.get_txpos
+        self.verifier.get_txpos = lambda tx_hash: calls.append(tx_hash) or get_txpos(tx_hash)
+        history = self.wallet.get_sorted_history()
+        self.assertEqual(['new', 'tx00'], sorted(calls))
+        self.assertEqual(20, len(history))
+        self.assertEqual(['tx00', 'new'], history[-2:])
+        self.assertEqual(['tx%02d' % i for i in range(1, 20) if i != 5], history[:-2])
+
+
+class TestAddressHistory(WalletTestCase):
+
+    def setUp(self):
+        super(TestAddressHistory, self).setUp()
+        self.wallet = NewWallet(WalletStorage(self.fake_config))
+
+    def test_index_follows_histories(self):
+        self.wallet.receive_history_callback('addr1', [('a', 10), ('b', 20)])
+        self.wallet.receive_history_callback('addr2', [('b', 20)])
+        self.assertEqual(set(['addr1', 'addr2']), self.wallet.tx_addresses['b'])
+        self.wallet.receive_history_callback('addr1', [('b', 20)])
+        self.assertFalse('a' in self.wallet.tx_addresses)
+        self.wallet.receive_history_callback('addr2', ['*'])
+        self.assertEqual(set(['addr1']), self.wallet.tx_addresses['b'])
+
+    def test_status_is_cached(self):
+        hist = [('a', 10), ('b', 20)]
+        self.assertEqual(None, self.wallet.get_address_status('addr1'))
+        self.wallet.receive_history_callback('addr1', hist)
+        self.assertEqual(self.wallet.get_status(hist), self.wallet.get_address_status('addr1'))
+        calls = []
+        self.wallet.get_status = lambda h: calls.append(h)
+        self.wallet.get_address_status('addr1')
+        self.assertEqual([], calls)
+
+
+class TestRestore(WalletTestCase):
+
+    def setUp(self):
+        super(TestRestore, self).setUp()
+        self.wallet = NewWallet(WalletStorage(self.fake_config))
+        self.wallet.add_seed(TestNewWallet.seed_text, TestNewWallet.password)
+        self.wallet.create_master_keys(TestNewWallet.password)
+        self.wallet.create_main_account(TestNewWallet.password)
+        self.account = self.wallet.default_account()
+        self.saves = []
+        save_accounts = self.wallet.save_accounts
+        self.wallet.save_accounts = lambda: self.saves.append(1) or save_accounts()
+
+    def test_window_is_extended_when_history_is_announced(self):
+        self.wallet.restoring = True
+        self.wallet.synchronize()
+        addresses = self.account.get_addresses(0)
+        self.assertEqual(20, len(addresses))
+        del self.saves[:]
+        self.wallet.receive_status_callback(addresses[5], 'ab'*32)
+        self.wallet.receive_status_callback(addresses[19], 'ab'*32)
+        self.wallet.synchronize()
+        # the window ends with exactly gap_limit unused addresses
+        self.assertEqual(40, len(self.account.get_addresses(0)))
+        self.assertEqual(1, len(self.saves))
+        self.assertTrue(self.wallet.progress_event.is_set())
+
+    def test_window_is_not_extended_past_gap_limit(self):
+        self.wallet.restoring = True
+        self.wallet.synchronize()
+        addresses = self.account.get_addresses(0)
+        self.wallet.receive_status_callback(addresses[5], 'ab'*32)
+        self.wallet.synchronize()
+        self.assertEqual(26, len(self.account.get_addresses(0)))
+
+    def test_window_waits_for_history_outside_restore(self):
+        self.wallet.synchronize()
+        addresses = self.account.get_addresses(0)
+        self.wallet.receive_status_callback(addresses[5], 'ab'*32)
+        self.wallet.synchronize()
+        self.assertEqual(20, len(self.account.get_addresses(0)))
+        self.assertEqual((len(self.wallet.addresses(True)), 1, 0), self.wallet.get_restore_progress())
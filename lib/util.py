@@ -290,8 +290,14 @@ class SocketPipe:
         out = json.dumps(request) + '\n'
         self._send(out)
 
-    def send_all(self, requests):
-        out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
+    def send_all(self, requests, batch_size=1):
+        """ send requests as JSON-RPC batch arrays of up to batch_size
+        requests, in a single write """
+        if batch_size > 1:
+            batches = [requests[i:i+batch_size] for i in range(0, len(requests), batch_size)]
+            out = ''.join(map(lambda x: json.dumps(x if len(x) > 1 else x[0]) + '\n', batches))
+        else:
+            out = ''.join(map(lambda x: json.dumps(x) + '\n', requests))
         self._send(out)
 
     def _send(self, out):
@@ -349,7 +355,46 @@ class QueuePipe:
     def send(self, request):
         self.send_queue.put(request)
 
-    def send_all(self, requests):
-        for request in requests:
-            self.send(request)
+    def send_all(self, requests, batch_size=1):
+        if batch_size > 1:
+            for i in range(0, len(requests), batch_size):
+                batch = requests[i:i+batch_size]
+                self.send(batch if len(batch) > 1 else batch[0])
+        else:
+            for request in requests:
+                self.send(request)
+
+
+
+
+import collections
+import threading
+
+class LRUCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            return self.items.pop(key, None)
 
+    def clear(self):
+        with self.lock:
+            self.items.clear()
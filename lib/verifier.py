@@ -17,13 +17,23 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
+import threading, time, Queue, os, sys, shutil, heapq, bisect
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 
 
 
 
+# merkle branches requested in one message batch
+MERKLE_BATCH = 100
+
+# minimum number of seconds between two writes of the verification results
+SAVE_INTERVAL = 10
+
+# upper bounds, in seconds, of the proof latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+
 class TxVerifier(threading.Thread):
     """ Simple Payment Verification """
 
@@ -35,47 +45,96 @@ class TxVerifier(threading.Thread):
         self.transactions    = {}                                 # requested verifications (with height sent by the requestor)
         self.verified_tx     = storage.get('verified_tx3',{})      # height, timestamp of verified transactions
         self.merkle_roots    = storage.get('merkle_roots',{})      # hashed by me
+        # verified transactions by block height, and the sorted heights
+        self.verified_by_height = {}
+        self.verified_heights = []
+        for tx_hash, (height, timestamp, pos) in self.verified_tx.items():
+            self.index_verified(tx_hash, height)
+        # the lock serializes writers. Readers do single dict lookups,
+        # which are atomic, and only take it to fill the tx_info cache.
         self.lock = threading.Lock()
         self.running = False
         self.queue = Queue.Queue()
+        # transactions waiting for a merkle request, by the height of the
+        # header needed to verify them; heights is a heap of its keys
+        self.pending = {}
+        self.heights = []
+        self.requested_merkle = set()
+        # verification results not written to the wallet file yet
+        self.dirty = False
+        self.last_save = 0
+        # counters for get_status, and request time of the proofs in flight
+        self.stats = {'requested':0, 'verified':0, 'failed':0, 'errors':0}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0
+        self.request_times = {}
+        # (txpos, conf, timestamp) by transaction, computed at the local
+        # height it is stored with. Entries are dropped when a transaction
+        # is added or its verification changes, all of them on a new height.
+        self.tx_info = (None, {})
+        # transactions whose txpos changed since the last pop_moved
+        self.moved = set()
+        # new headers make pending transactions verifiable
+        self.network.register_callback('updated', self.wakeup)
 
 
     def get_confirmations(self, tx):
         """ return the number of confirmations of a monitored transaction. """
-        with self.lock:
-            if tx in self.verified_tx:
-                height, timestamp, pos = self.verified_tx[tx]
-                conf = (self.network.get_local_height() - height + 1)
-                if conf <= 0: timestamp = None
-
-            elif tx in self.transactions:
-                conf = -1
-                timestamp = None
-
-            else:
-                conf = 0
-                timestamp = None
-
-        return conf, timestamp
+        return self.get_tx_info(tx)[1:]
 
 
     def get_txpos(self, tx_hash):
         "return position, even if the tx is unverified"
+        return self.get_tx_info(tx_hash)[0]
+
+
+    def get_tx_info(self, tx_hash):
+        """ return txpos, confirmations and timestamp of a transaction.
+        Cache hits do not take the lock. """
+        local_height = self.network.get_local_height()
+        height, cache = self.tx_info
+        if height == local_height:
+            info = cache.get(tx_hash)
+            if info is not None:
+                return info
         with self.lock:
-            x = self.verified_tx.get(tx_hash)
-            y = self.transactions.get(tx_hash)
-        if x:
-            height, timestamp, pos = x
-            return height, pos
+            height, cache = self.tx_info
+            if height != local_height:
+                cache = {}
+                self.tx_info = (local_height, cache)
+            info = cache[tx_hash] = self.compute_tx_info(tx_hash, local_height)
+        return info
+
+    def compute_tx_info(self, tx_hash, local_height):
+        # called with lock held
+        v = self.verified_tx.get(tx_hash)
+        y = self.transactions.get(tx_hash)
+        if v:
+            height, timestamp, pos = v
+            conf = local_height - height + 1
+            if conf <= 0: timestamp = None
+            return (height, pos), conf, timestamp
         elif y:
-            return y, 0
+            return (y, 0), -1, None
         else:
-            return 1e12, 0
+            return (1e12, 0), 0, None
 
+    def invalidate(self, tx_hash):
+        # called with lock held, when the txpos of tx_hash changes
+        self.tx_info[1].pop(tx_hash, None)
+        self.moved.add(tx_hash)
 
-    def get_height(self, tx_hash):
+    def pop_moved(self):
+        """ return the transactions whose txpos changed since the last
+        call """
         with self.lock:
-            v = self.verified_tx.get(tx_hash)
+            moved = self.moved
+            self.moved = set()
+        return moved
+
+
+    def get_height(self, tx_hash):
+        v = self.verified_tx.get(tx_hash)
         height = v[0] if v else None
         return height
 
@@ -84,11 +143,55 @@ class TxVerifier(threading.Thread):
         """ add a transaction to the list of monitored transactions. """
         assert tx_height > 0
         with self.lock:
-            if tx_hash not in self.transactions.keys():
+            if tx_hash not in self.transactions:
                 self.transactions[tx_hash] = tx_height
+                self.invalidate(tx_hash)
+                if tx_hash not in self.verified_tx:
+                    self.add_pending(tx_hash, tx_height)
+        self.wakeup()
+
+    def index_verified(self, tx_hash, height):
+        # called with lock held, or before the thread starts
+        txs = self.verified_by_height.get(height)
+        if txs is None:
+            txs = self.verified_by_height[height] = set()
+            bisect.insort(self.verified_heights, height)
+        txs.add(tx_hash)
+
+    def add_pending(self, tx_hash, tx_height):
+        # called with lock held
+        if tx_height not in self.pending:
+            self.pending[tx_height] = set()
+            heapq.heappush(self.heights, tx_height)
+        self.pending[tx_height].add(tx_hash)
+
+    def wakeup(self):
+        self.queue.put(None)
 
     def stop(self):
         with self.lock: self.running = False
+        self.network.unregister_callback('updated', self.wakeup)
+        self.wakeup()
+        self.save()
+
+    def save(self):
+        """ write verified_tx3 and merkle_roots in a single wallet write """
+        with self.lock:
+            if not self.dirty:
+                return
+            verified_tx = dict(self.verified_tx)
+            merkle_roots = dict(self.merkle_roots)
+            self.dirty = False
+            self.last_save = time.time()
+        self.storage.put('merkle_roots', merkle_roots, False)
+        self.storage.put('verified_tx3', verified_tx, True)
+
+    def save_timeout(self):
+        """ seconds until unsaved results must be written, or None """
+        with self.lock:
+            if not self.dirty:
+                return None
+            return max(0, self.last_save + SAVE_INTERVAL - time.time())
 
     def is_running(self):
         with self.lock: return self.running
@@ -96,78 +199,185 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
 
         while self.is_running():
-            # request missing tx
-            for tx_hash, tx_height in self.transactions.items():
-                if tx_hash not in self.verified_tx:
-                    # do not request merkle branch before headers are available
-                    if tx_height > self.network.get_local_height():
-                        continue
-                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
-                        if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], self.queue.put):
-                            print_error('requesting merkle', tx_hash)
-                            requested_merkle.append(tx_hash)
+            self.request_merkles()
 
+            # None wakes the thread up, for new transactions, new headers
+            # or stop. Unsaved results are written after SAVE_INTERVAL.
             try:
-                r = self.queue.get(timeout=0.1)
+                r = self.queue.get(timeout=self.save_timeout())
             except Queue.Empty:
+                self.save()
                 continue
-
             if not r: continue
 
+            # the answers to a batch of requests arrive together
+            responses = [r]
+            while True:
+                try:
+                    r = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if r: responses.append(r)
+            self.process_responses(responses)
+
+
+    def request_merkles(self):
+        """ request the merkle branches of the pending transactions whose
+        header is available """
+        # do not request merkle branch before headers are available
+        local_height = self.network.get_local_height()
+        with self.lock:
+            ready = []
+            while self.heights and self.heights[0] <= local_height:
+                tx_height = heapq.heappop(self.heights)
+                ready += [(tx_hash, tx_height) for tx_hash in self.pending.pop(tx_height)]
+        ready = [(tx_hash, tx_height) for tx_hash, tx_height in ready
+                 if tx_hash not in self.verified_tx and tx_hash not in self.requested_merkle
+                 and self.merkle_roots.get(tx_hash) is None]
+        for i in range(0, len(ready), MERKLE_BATCH):
+            batch = ready[i:i+MERKLE_BATCH]
+            messages = [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in batch]
+            if self.network.send(messages, self.queue.put):
+                print_error('requesting %d merkle branches'%len(batch))
+                self.requested_merkle.update(tx_hash for tx_hash, tx_height in batch)
+                now = time.time()
+                with self.lock:
+                    self.stats['requested'] += len(batch)
+                    for tx_hash, tx_height in batch:
+                        self.request_times[tx_hash] = now
+            else:
+                # retried on the next wake up
+                with self.lock:
+                    for tx_hash, tx_height in batch:
+                        self.add_pending(tx_hash, tx_height)
+
+    def process_responses(self, responses):
+        """ verify a batch of merkle branches, reading the header of each
+        block once """
+        blocks = {}
+        for r in responses:
             if r.get('error'):
                 print_error('Verifier received an error:', r)
+                with self.lock:
+                    self.stats['errors'] += 1
+                    self.request_times.pop(r['params'][0], None)
                 continue
-
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r['result']
-
-            if method == 'blockchain.transaction.get_merkle':
-                tx_hash = params[0]
-                self.verify_merkle(tx_hash, result)
-
-
-    def verify_merkle(self, tx_hash, result):
-        tx_height = result.get('block_height')
-        pos = result.get('pos')
-        merkle_root = self.hash_merkle_root(result['merkle'], tx_hash, pos)
+            if r['method'] == 'blockchain.transaction.get_merkle':
+                tx_hash = r['params'][0]
+                result = r['result']
+                blocks.setdefault(result.get('block_height'), []).append((tx_hash, result))
+
+        verified = 0
+        for tx_height, items in blocks.items():
+            verified += self.verify_block(tx_height, items)
+        if verified:
+            if not self.save_timeout():
+                self.save()
+            self.network.trigger_callback('updated')
+
+    def verify_block(self, tx_height, items):
+        """ verify the merkle branches of transactions of the same block.
+        Returns the number of verified transactions. """
         header = self.network.get_header(tx_height)
-        if not header: return
-        if header.get('merkle_root') != merkle_root:
-            print_error("merkle verification failed for", tx_hash)
-            return
-
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = merkle_root
+        if not header:
+            print_error("no header for block", tx_height)
+            with self.lock:
+                self.stats['failed'] += len(items)
+                for tx_hash, result in items:
+                    self.request_times.pop(tx_hash, None)
+            return 0
+        merkle_root = header.get('merkle_root')
         timestamp = header.get('timestamp')
-        with self.lock:
-            self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
-        print_error("verified %s"%tx_hash)
-        self.storage.put('verified_tx3', self.verified_tx, True)
-        self.network.trigger_callback('updated')
-
+        # merkle tree nodes of the block already proven, by (level, index)
+        proven = {}
+        n = 0
+        for tx_hash, result in items:
+            pos = result.get('pos')
+            if not self.check_merkle_branch(result['merkle'], tx_hash, pos, merkle_root, proven):
+                print_error("merkle verification failed for", tx_hash)
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.request_times.pop(tx_hash, None)
+                continue
 
-    def hash_merkle_root(self, merkle_s, target_hash, pos):
+            # we passed all the tests
+            with self.lock:
+                self.merkle_roots[tx_hash] = merkle_root
+                self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
+                self.index_verified(tx_hash, tx_height)
+                self.invalidate(tx_hash)
+                self.dirty = True
+                self.stats['verified'] += 1
+                t = self.request_times.pop(tx_hash, None)
+                if t is not None:
+                    self.observe_latency(time.time() - t)
+            print_error("verified %s"%tx_hash)
+            n += 1
+        return n
+
+    def observe_latency(self, seconds):
+        # called with lock held
+        self.latency[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_sum += seconds
+
+    def get_status(self):
+        """ counters and gauges describing how far behind verification is """
+        local_height = self.network.get_local_height()
+        now = time.time()
+        with self.lock:
+            status = dict(self.stats)
+            status['in_flight'] = len(self.request_times)
+            status['oldest_request_age'] = now - min(self.request_times.values()) if self.request_times else 0
+            status['waiting_for_headers'] = sum(len(txs) for h, txs in self.pending.items() if h > local_height)
+            status['pending'] = sum(len(txs) for txs in self.pending.values())
+            status['verified_total'] = len(self.verified_tx)
+            status['unverified'] = len([tx_hash for tx_hash in self.transactions if tx_hash not in self.verified_tx])
+            count = 0
+            buckets = []
+            for bound, n in zip(LATENCY_BUCKETS + ['+Inf'], self.latency):
+                count += n
+                buckets.append((bound, count))
+            status['latency'] = {'count':count, 'sum':self.latency_sum, 'buckets':buckets}
+        return status
+
+    def check_merkle_branch(self, merkle_s, target_hash, pos, merkle_root, proven):
+        """ check a merkle branch against merkle_root. The branch stops
+        being hashed when it reaches a node in proven, and its own nodes
+        are added to proven once it is checked. """
         h = hash_decode(target_hash)
+        nodes = []
         for i in range(len(merkle_s)):
-            item = merkle_s[i]
-            h = Hash( hash_decode(item) + h ) if ((pos >> i) & 1) else Hash( h + hash_decode(item) )
-        return hash_encode(h)
-
-
+            known = proven.get((i, pos >> i))
+            if known is not None:
+                if known != h:
+                    return False
+                break
+            item = hash_decode(merkle_s[i])
+            nodes.append(((i, pos >> i), h))
+            nodes.append(((i, (pos >> i) ^ 1), item))
+            h = Hash( item + h ) if ((pos >> i) & 1) else Hash( h + item )
+        else:
+            if hash_encode(h) != merkle_root:
+                return False
+        proven.update(nodes)
+        return True
 
     def undo_verifications(self, height):
+        """ forget the verifications of the blocks at or above height, and
+        verify their transactions again """
         with self.lock:
-            items = self.verified_tx.items()[:]
-        for tx_hash, item in items:
-            tx_height, timestamp, pos = item
-            if tx_height >= height:
-                print_error("redoing", tx_hash)
-                with self.lock:
-                    self.verified_tx.pop(tx_hash)
-                    if tx_hash in self.merkle_roots:
-                        self.merkle_roots.pop(tx_hash)
+            i = bisect.bisect_left(self.verified_heights, height)
+            for tx_height in self.verified_heights[i:]:
+                for tx_hash in self.verified_by_height.pop(tx_height):
+                    print_error("redoing", tx_hash)
+                    self.verified_tx.pop(tx_hash, None)
+                    self.merkle_roots.pop(tx_hash, None)
+                    self.requested_merkle.discard(tx_hash)
+                    self.invalidate(tx_hash)
+                    if tx_hash in self.transactions:
+                        self.add_pending(tx_hash, self.transactions[tx_hash])
+                    self.dirty = True
+            del self.verified_heights[i:]
+        self.wakeup()
@@ -26,6 +26,7 @@ import time
 import math
 import json
 import copy
+import bisect
 
 from util import print_msg, print_error
 
@@ -161,6 +162,11 @@ class Abstract_Wallet(object):
         self.addressbook           = storage.get('contacts', [])
 
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.tx_addresses = {}     # txid -> addresses whose history has it
+        self.address_status = {}   # address -> status hash of its history
+        self.server_status = {}    # address -> status announced by the server
+        for addr, hist in self.history.items():
+            self.update_tx_addresses(addr, [], hist)
         self.fee_per_kb            = int(storage.get('fee_per_kb', RECOMMENDED_FEE))
 
         # This attribute is set when wallet.start_threads is called.
@@ -178,6 +184,9 @@ class Abstract_Wallet(object):
         self.spent_outputs = []
         # spv
         self.verifier = None
+        # (txpos, tx_hash) of the transactions, kept sorted by get_tx_history
+        self.sorted_history = []
+        self.sorted_txpos = {}
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
@@ -185,6 +194,9 @@ class Abstract_Wallet(object):
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
+        # set while restore is running, and when it has progress to show
+        self.restoring = False
+        self.progress_event = threading.Event()
         for tx_hash, tx in self.transactions.items():
             self.update_tx_outputs(tx_hash)
 
@@ -264,6 +276,7 @@ class Abstract_Wallet(object):
 
     def set_up_to_date(self,b):
         with self.lock: self.up_to_date = b
+        self.progress_event.set()
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -577,6 +590,18 @@ class Abstract_Wallet(object):
         with self.lock:
             return self.history.get(address)
 
+    def receive_status_callback(self, addr, status):
+        self.server_status[addr] = status
+        self.progress_event.set()
+
+    def get_address_status(self, addr):
+        """ status hash of the history of addr, compared with the one
+        announced by the server """
+        with self.lock:
+            if addr not in self.address_status:
+                self.address_status[addr] = self.get_status(self.history.get(addr))
+            return self.address_status[addr]
+
     def get_status(self, h):
         if not h: return None
         if h == ['*']: return '*'
@@ -599,6 +624,7 @@ class Abstract_Wallet(object):
             if self.verifier and tx_height>0:
                 self.verifier.add(tx_hash, tx_height)
             self.update_tx_outputs(tx_hash)
+        self.progress_event.set()
 
     def save_transactions(self):
         tx = {}
@@ -612,8 +638,11 @@ class Abstract_Wallet(object):
             raise Exception("error: received history for %s is not consistent with known transactions"%addr)
 
         with self.lock:
+            self.update_tx_addresses(addr, self.history.get(addr, []), hist)
             self.history[addr] = hist
+            self.address_status[addr] = self.get_status(hist)
             self.storage.put('addr_history', self.history, True)
+        self.progress_event.set()
 
         if hist != ['*']:
             for tx_hash, tx_height in hist:
@@ -621,13 +650,25 @@ class Abstract_Wallet(object):
                     # add it in case it was previously unconfirmed
                     if self.verifier: self.verifier.add(tx_hash, tx_height)
 
+    def update_tx_addresses(self, addr, old_hist, hist):
+        # called with lock held, or from __init__
+        if old_hist != ['*']:
+            for tx_hash, height in old_hist:
+                addresses = self.tx_addresses.get(tx_hash)
+                if addresses:
+                    addresses.discard(addr)
+                    if not addresses:
+                        self.tx_addresses.pop(tx_hash)
+        if hist != ['*']:
+            for tx_hash, height in hist:
+                self.tx_addresses.setdefault(tx_hash, set()).add(addr)
+
     def get_tx_history(self, account=None):
         if not self.verifier:
             return []
 
         with self.transaction_lock:
-            history = self.transactions.items()
-            history.sort(key = lambda x: self.verifier.get_txpos(x[0]))
+            history = [(tx_hash, self.transactions[tx_hash]) for tx_hash in self.get_sorted_history()]
             result = []
 
             balance = 0
@@ -653,6 +694,30 @@ class Abstract_Wallet(object):
 
         return result
 
+    def get_sorted_history(self):
+        """ return the transaction hashes sorted by txpos. Only the
+        transactions that were added, removed or moved by the verifier
+        since the last call are re-sorted. Called with transaction_lock. """
+        keys = self.sorted_txpos
+        moved = self.verifier.pop_moved()
+        moved.update(keys.viewkeys() ^ self.transactions.viewkeys())
+        if len(moved) * 4 > len(self.sorted_history):
+            for tx_hash in moved:
+                keys.pop(tx_hash, None)
+            for tx_hash in self.transactions:
+                if tx_hash not in keys:
+                    keys[tx_hash] = self.verifier.get_txpos(tx_hash)
+            self.sorted_history = sorted((txpos, tx_hash) for tx_hash, txpos in keys.items())
+        else:
+            for tx_hash in moved:
+                txpos = keys.pop(tx_hash, None)
+                if txpos is not None:
+                    del self.sorted_history[bisect.bisect_left(self.sorted_history, (txpos, tx_hash))]
+                if tx_hash in self.transactions:
+                    txpos = keys[tx_hash] = self.verifier.get_txpos(tx_hash)
+                    bisect.insort(self.sorted_history, (txpos, tx_hash))
+        return [tx_hash for txpos, tx_hash in self.sorted_history]
+
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash)
         is_default = (label == '') or (label is None)
@@ -872,6 +937,8 @@ class Abstract_Wallet(object):
 
     def set_verifier(self, verifier):
         self.verifier = verifier
+        self.sorted_history = []
+        self.sorted_txpos = {}
 
         # review transactions that are in the history
         for addr, hist in self.history.items():
@@ -900,16 +967,10 @@ class Abstract_Wallet(object):
         old_hist = self.history.get(addr,[])
         if old_hist == ['*']: return True
 
+        txids = set(x[0] for x in hist)
         for tx_hash, height in old_hist:
-            if tx_hash in map(lambda x:x[0], hist): continue
-            found = False
-            for _addr, _hist in self.history.items():
-                if _addr == addr: continue
-                if _hist == ['*']: continue
-                _tx_hist = map(lambda x:x[0], _hist)
-                if tx_hash in _tx_hist:
-                    found = True
-                    break
+            if tx_hash in txids: continue
+            found = bool(self.tx_addresses.get(tx_hash, set()) - set([addr]))
 
             if not found:
                 tx = self.transactions.get(tx_hash)
@@ -946,13 +1007,7 @@ class Abstract_Wallet(object):
 
     def check_new_tx(self, tx_hash, tx):
         # 1 check that tx is referenced in addr_history.
-        addresses = []
-        for addr, hist in self.history.items():
-            if hist == ['*']:continue
-            for txh, height in hist:
-                if txh == tx_hash:
-                    addresses.append(addr)
-
+        addresses = list(self.tx_addresses.get(tx_hash, []))
         if not addresses:
             return False
 
@@ -1022,6 +1077,14 @@ class Abstract_Wallet(object):
                 age = tx_age
         return age > age_limit
 
+    def address_is_announced(self, address):
+        """ whether a server announced a history for address, which may
+        not be received yet """
+        return self.server_status.get(address) is not None or self.address_is_old(address)
+
+    def is_restoring(self):
+        return self.restoring
+
     def can_sign(self, tx):
         pass
 
@@ -1156,39 +1219,67 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
-        if self.synchronizer:
-            self.synchronizer.add(address)
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        for address in addresses:
+            if address not in self.history:
+                self.history[address] = []
+            if self.synchronizer:
+                self.synchronizer.add(address)
         self.save_accounts()
+        self.progress_event.set()
 
     def synchronize(self):
         for account in self.accounts.values():
             account.synchronize(self)
 
+    def get_restore_progress(self):
+        """ number of addresses generated, of addresses with a history
+        announced by the server, and of transactions received """
+        addresses = self.addresses(True)
+        used = len([addr for addr in addresses if self.server_status.get(addr) is not None])
+        return len(addresses), used, len(self.transactions)
+
     def restore(self, callback):
+        """ generate the addresses of the wallet and fetch their history.
+        Addresses are subscribed a gap limit window at a time, and callback
+        gets a progress message each time there is progress. """
         from i18n import _
         def wait_for_wallet():
+            self.restoring = True
             self.set_up_to_date(False)
+            # the synchronizer sets the wallet up to date again once it
+            # has nothing left to fetch
+            if self.synchronizer:
+                self.synchronizer.wakeup()
             while not self.is_up_to_date():
-                msg = "%s\n%s %d"%(
+                self.progress_event.clear()
+                addresses, used, transactions = self.get_restore_progress()
+                msg = "%s\n%s %d\n%s %d\n%s %d"%(
                     _("Please wait..."),
-                    _("Addresses generated:"),
-                    len(self.addresses(True)))
-
+                    _("Addresses generated:"), addresses,
+                    _("Used addresses found:"), used,
+                    _("Transactions received:"), transactions)
                 apply(callback, (msg,))
-                time.sleep(0.1)
+                self.progress_event.wait(1)
+            self.restoring = False
 
         def wait_for_network():
             while not self.network.is_connected():
+                self.progress_event.clear()
                 msg = "%s \n" % (_("Connecting..."))
                 apply(callback, (msg,))
-                time.sleep(0.1)
+                self.progress_event.wait(1)
 
         # wait until we are connected, because the user might have selected another server
         if self.network:
-            wait_for_network()
-            wait_for_wallet()
+            self.network.register_callback('status', self.progress_event.set)
+            try:
+                wait_for_network()
+                wait_for_wallet()
+            finally:
+                self.network.unregister_callback('status', self.progress_event.set)
         else:
             self.synchronize()
         self.fill_addressbook()
@@ -87,6 +87,7 @@ setup(
         'electrum_myr.bitcoin',
         'electrum_myr.blockchain',
         'electrum_myr.bmp',
+        'electrum_myr.checkpoints',
         'electrum_myr.commands',
         'electrum_myr.daemon',
         'electrum_myr.i18n',